@@ -1,21 +1,31 @@
+import csv
+import io
 import json
+import time
 from uuid import uuid4
 
-import bcrypt
 import jwt
 import pymysql
 import qrcode
 import requests
 from PIL import Image
-from email_validator import EmailNotValidError, validate_email
-from flask import Blueprint, request, send_from_directory
+from email_validator import EmailNotValidError
+from flask import Blueprint, Response, request, send_from_directory
 from jwt import InvalidSignatureError
 # from urlvalidator import URLValidator
 from pytz import timezone
 
+import events
+import http_cache
+import jwt_cache
+import kitchen
+import menu_cache
 import paytm
-from config import jwt_secret
-from db_utils import connection
+import restaurant_cache
+from config import jwt_secret, kitchen_stream_ticket_ttl
+from db_utils import connection, pin_to_primary
+from emails import validate_signup_email
+from passwords import hash_password, password_valid, needs_rehash, PasswordHasherBusy
 from user_endpoints import get_menu
 
 admin = Blueprint('admin', __name__)
@@ -37,13 +47,9 @@ def version():
         }
 
 
-def password_valid(password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
-
-
 def authenticate(_requests):
     try:
-        decoded_jwt = jwt.decode(_requests.headers['X-Auth-Token'], jwt_secret, algorithms=['HS256'])
+        decoded_jwt = jwt_cache.decode(_requests.headers['X-Auth-Token'])
         admin_id = decoded_jwt['user_id']
         is_admin = decoded_jwt['is_admin']
 
@@ -129,7 +135,7 @@ def create_admin():
 
         try:
             # validating email and assigning the valid email back to email
-            email_id = validate_email(email_id).email
+            email_id = validate_signup_email(email_id)
             with connection() as conn, conn.cursor() as cur:
                 cur.execute("select email_address from admin where email_address = %s", email_id)
                 if cur.rowcount == 1:
@@ -150,7 +156,7 @@ def create_admin():
             return ({'error': f'password should be between {MinPasswordLength} ' f'and {MaxPasswordLength} characters'},
                     ValidationError)
 
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        hashed_password = hash_password(password)
         try:
             with connection() as conn, conn.cursor() as cur:
                 admin_id = str(uuid4())
@@ -195,11 +201,23 @@ def authenticate_user():
             row = cur.fetchone()
             hashed_password = row[1]
             user_id = row[0]
-            if password_valid(password, hashed_password):
-                jwt_token = jwt.encode({'user_id': user_id, "is_admin": True}, jwt_secret, algorithm='HS256')
-                return {"jwt": jwt_token}
+
+        # the connection is back in the pool while bcrypt runs
+        if not password_valid(password, hashed_password):
             return {"error": "Email and Password doesn't match."}
 
+        if needs_rehash(hashed_password):
+            # upgrade hashes made with an older, lower work factor
+            try:
+                password_hash = hash_password(password)
+                with connection() as conn, conn.cursor() as cur:
+                    cur.execute("update admin set password = %s where id = %s", (password_hash, user_id))
+                    conn.commit()
+            except PasswordHasherBusy:
+                pass
+        jwt_token = jwt.encode({'user_id': user_id, "is_admin": True}, jwt_secret, algorithm='HS256')
+        return {"jwt": jwt_token}
+
     except KeyError:
         return {"error": "Some Credentials Missing."}, ValidationError
 
@@ -297,6 +315,7 @@ def add_restaurant():
                 "insert into restaurant(id,name,description,photo_url,tax_percent,admin_id,address,pincode) values (%s,%s,%s,%s,%s,%s,%s,%s)",
                 (restaurant_id, name, description, photo_url, tax_percentage, admin_id, address, pincode))
             conn.commit()
+        restaurant_cache.invalidate_admin(admin_id)
         return {'restaurant_id': restaurant_id}
     except KeyError:
         return {"error": "Some Credentials are missing."}, ValidationError
@@ -342,13 +361,7 @@ def create_table():
         return {'error': 'Invalid input'}, ValidationError
 
     with connection() as conn, conn.cursor() as cur:
-        cur.execute(
-            'select name from restaurant '
-            'where id = %s and admin_id = %s',
-            (restaurant_id, admin_id)
-        )
-
-        if cur.rowcount == 0:
+        if not restaurant_cache.is_owner(conn, restaurant_id, admin_id):
             return {'error': 'Restaurant not found'}, ValidationError
 
         # mysql version deployed on heroku does not support retuning clause
@@ -362,6 +375,7 @@ def create_table():
         table_id = cur.fetchone()[0]
 
         conn.commit()
+        restaurant_cache.invalidate(restaurant_id)
 
         return {'table_id': table_id}
 
@@ -400,7 +414,7 @@ def delete_table():
 
         # we need to check whether the user is the admin of the restaurant
         # whose table they are trying to delete
-        restaurant_ids = get_restaurant_ids(admin_id, cur)
+        restaurant_ids = restaurant_cache.restaurant_ids(conn, admin_id)
 
         if len(restaurant_ids) == 0:
             return {'error': 'You do not administer any restaurant'}, ValidationError
@@ -414,23 +428,12 @@ def delete_table():
             return {'error': 'The table does not exist or you do not own the restaurant'}, ValidationError
 
         conn.commit()
+        # we don't know which of the admin's restaurants had the table
+        for restaurant_id in restaurant_ids:
+            restaurant_cache.invalidate(restaurant_id)
         return {'success': True}
 
 
-def get_restaurant_ids(admin_id, cur):
-    cur.execute(
-        'select id from restaurant where admin_id = %s',
-        (admin_id,)
-    )
-    # cur.fetchall() returns a list of tuples but we want a tuple
-    # of restaurant ids.
-    #
-    # it needs to be tuple because we will need to "in" clause in
-    # sql which doesn't work with list
-    restaurant_ids = tuple(map(lambda x: x[0], cur.fetchall()))
-    return restaurant_ids
-
-
 @admin.route('/rename_table', methods=['PUT'])
 def update_table():
     """
@@ -470,7 +473,7 @@ def update_table():
     with connection() as conn, conn.cursor() as cur:
         # we need to check whether the user is the admin of the restaurant
         # whose table they are trying to delete
-        restaurant_ids = get_restaurant_ids(admin_id, cur)
+        restaurant_ids = restaurant_cache.restaurant_ids(conn, admin_id)
 
         if len(restaurant_ids) == 0:
             return {'error': 'You do not administer any restaurant'}, ValidationError
@@ -483,8 +486,16 @@ def update_table():
         if cur.rowcount == 0:
             return {'error': 'The table does not exist or you do not own the restaurant'}, ValidationError
 
+        cur.execute('select restaurant_id from tables where id = %s', (table_id,))
+        restaurant_id = cur.fetchone()[0]
+        # the kitchen board shows tickets under the table's name
+        kitchen.table_renamed(cur, restaurant_id, table_id, new_table_name)
+
         conn.commit()
-        return {'success': True}
+        restaurant_cache.invalidate(restaurant_id)
+
+    events.publish(events.TableRenamed(table_id, restaurant_id, new_table_name))
+    return {'success': True}
 
 
 # unauthenticated route because this information is nothing secret
@@ -522,13 +533,19 @@ def get_all_tables():
     if not restaurant_id:
         return {'error': 'Restaurant id not found'}, ValidationError
 
-    with connection() as conn, conn.cursor() as cur:
-        cur.execute(
-            'select id, name from tables where restaurant_id = %s',
-            (restaurant_id,)
-        )
+    # only touches the database when the restaurant is not cached
+    restaurant = restaurant_cache.get(None, restaurant_id)
+    if restaurant is None:
+        return {'tables': []}
 
-        return {'tables': list(map(lambda x: {'id': x[0], 'name': x[1]}, cur.fetchall()))}
+    response = http_cache.not_modified(restaurant.tables_etag)
+    if response:
+        return response
+
+    return http_cache.cacheable(
+        {'tables': list(map(lambda x: {'id': x[0], 'name': x[1]}, restaurant.tables))},
+        restaurant.tables_etag
+    )
 
 
 @admin.route("/profile", methods=['GET'])
@@ -577,7 +594,7 @@ def update_profile():
             return {"error": "Mobile Number is not valid."}
         try:
             # validating email and assigning the valid email back to email
-            email_id = validate_email(email_address).email
+            email_id = validate_signup_email(email_address)
             with connection() as conn, conn.cursor() as cur:
                 cur.execute("select * from admin where id = %s", admin_id)
                 if cur.rowcount < 1:
@@ -658,8 +675,7 @@ def new_menu():
         if not menu_price.isdigit():
             return {"error": "Price should be in digit."}, ValidationError
         with connection() as conn, conn.cursor(pymysql.cursors.DictCursor) as cur:
-            cur.execute("Select admin_id from restaurant where id = %s", restaurant_id)
-            if not cur.fetchone()['admin_id'] == admin_id:
+            if not restaurant_cache.is_owner(conn, restaurant_id, admin_id):
                 return {"error": "Restaurant and Requesting Admin Pair doesn't exists."}, ValidationError
             cur.execute(
                 "insert into menu(name, description, photo_url, restaurant_id, price) values (%s,%s,%s,%s,%s)",
@@ -668,6 +684,7 @@ def new_menu():
             row = cur.fetchone()
             menu_id = row['last_insert_id()']
             conn.commit()
+        menu_cache.invalidate(restaurant_id)
         return {'success': "New Menu Successfully added.", 'menu_id': menu_id}
     except KeyError:
         return {"error": "Important Information Missing "}, ValidationError
@@ -675,6 +692,137 @@ def new_menu():
         return {"error": "Invalid Information"}, ValidationError
 
 
+MaxImportRows = 1000
+
+
+def _validate_menu_row(row):
+    """Returns (name, description, photo, price) or raises ValueError with the reason"""
+    try:
+        values = [row["name"], row["description"], row["photo"], row["price"]]
+    except (KeyError, TypeError):
+        raise ValueError("name, description, photo and price are required.")
+    # csv.DictReader gives None for the columns a short line is missing
+    if None in values:
+        raise ValueError("name, description, photo and price are required.")
+
+    name = str(values[0]).strip()
+    description = str(values[1])
+    photo = str(values[2])
+    price = str(values[3]).strip()
+
+    # same rules as new_menu
+    if len(name) < 3 or len(name) > 50:
+        raise ValueError("Name of Food Item must be of length between 3 and 50.")
+    if not price.isdigit():
+        raise ValueError("Price should be in digit.")
+
+    return name, description, photo, price
+
+
+@admin.route("/import_menu", methods=["POST"])
+def import_menu():
+    """
+        Adds many menu items at once.
+        url - /api/v1/admin/import_menu?restaurant_id=<id>&strict=<true/false>
+        Header: X-Auth-Token: <jwt>
+
+        Body is either json -
+            {
+                "items": [
+                    {"name": "Name", "description": "Desc", "photo": "Photo.jpeg", "price": 20},
+                    ...
+                ]
+            }
+        or just the json array of items, or csv (Content-Type: text/csv) with a header row -
+            name,description,photo,price
+            Name,Desc,Photo.jpeg,20
+
+        Every row is validated first. Rows with errors are skipped and reported,
+        unless strict=true in which case nothing is added if any row is invalid.
+
+        Sample Output:
+            {
+                "menu_ids": [12, 13],
+                "errors": [
+                    {"row": 2, "error": "Price should be in digit."}
+                ]
+            }
+    """
+    admin_id = authenticate(request)
+    if not admin_id:
+        return {"error": "User Authentication Failed."}, ValidationError
+
+    restaurant_id = request.args.get("restaurant_id")
+    if not restaurant_id:
+        return {"error": "Restaurant id not found"}, ValidationError
+    strict = request.args.get("strict", "false").lower() == "true"
+
+    # before looking at the rows, someone else's restaurant gets no per row errors
+    if not restaurant_cache.is_owner(None, restaurant_id, admin_id):
+        return {"error": "Restaurant and Requesting Admin Pair doesn't exists."}, ValidationError
+
+    if request.mimetype == "text/csv":
+        rows = list(csv.DictReader(io.StringIO(request.get_data(as_text=True))))
+    elif isinstance(request.json, list):
+        rows = request.json
+    elif isinstance(request.json, dict) and isinstance(request.json.get("items"), list):
+        rows = request.json["items"]
+    else:
+        return {"error": "Send items as json or csv."}, ValidationError
+
+    if len(rows) == 0:
+        return {"error": "No items found."}, ValidationError
+    if len(rows) > MaxImportRows:
+        return {"error": f"At most {MaxImportRows} items can be imported at once."}, ValidationError
+
+    valid_rows = []
+    errors = []
+    # rows are numbered from 1 like in a spreadsheet
+    for number, row in enumerate(rows, start=1):
+        try:
+            valid_rows.append(_validate_menu_row(row))
+        except ValueError as e:
+            errors.append({"row": number, "error": str(e)})
+
+    if errors and strict:
+        return {"error": "Invalid items, nothing was imported.", "errors": errors}, ValidationError
+    if not valid_rows:
+        return {"menu_ids": [], "errors": errors}
+
+    with connection() as conn, conn.cursor() as cur:
+        # one statement for the whole menu instead of a round trip per item
+        cur.execute(
+            "insert into menu(name, description, photo_url, restaurant_id, price) values " +
+            ", ".join(["(%s,%s,%s,%s,%s)"] * len(valid_rows)),
+            [value
+             for name, description, photo, price in valid_rows
+             for value in (name, description, photo, restaurant_id, price)]
+        )
+
+        # last_insert_id() is the id of the first row of a multi row insert,
+        # and the rows are assumed to have the ids that follow it. InnoDB
+        # allocates them in one go for an insert whose row count is known up
+        # front, but with innodb_autoinc_lock_mode = 2 (the default since
+        # mysql 8) the documentation no longer promises that. So the range is
+        # checked, and the import is rolled back rather than answered with
+        # ids of someone else's rows
+        inserted = cur.rowcount
+        cur.execute(
+            "select id from menu "
+            "where restaurant_id = %s and id between last_insert_id() and last_insert_id() + %s - 1 "
+            "order by id",
+            (restaurant_id, inserted)
+        )
+        menu_ids = list(map(lambda row: row[0], cur.fetchall()))
+        if len(menu_ids) != inserted:
+            print('import_menu: ids of the %d new items are not consecutive' % inserted)
+            return {"error": "Menu could not be imported, please try again."}, ValidationError
+        conn.commit()
+
+    menu_cache.invalidate(restaurant_id)
+    return {"menu_ids": menu_ids, "errors": errors}
+
+
 @admin.route("/delete_menu", methods=["POST"])
 def delete_menu():
     """
@@ -696,9 +844,10 @@ def delete_menu():
         menu_id = request.json['menu_id']
         with connection() as conn, conn.cursor(pymysql.cursors.DictCursor) as cur:
             cur.execute(
-                "Select restaurant.admin_id from restaurant inner join menu on restaurant.id = menu.restaurant_id where menu.id = %s",
+                "Select restaurant.id, restaurant.admin_id from restaurant inner join menu on restaurant.id = menu.restaurant_id where menu.id = %s",
                 menu_id)
-            if not admin_id == cur.fetchone()['admin_id']:
+            restaurant = cur.fetchone()
+            if not admin_id == restaurant['admin_id']:
                 return {"error": "Requesting Admin and Menu Pair doesn't exists."}, ValidationError
             cur.execute(
                 "Select orders.table_id from orders inner join order_items on orders.id = order_items.order_id where (order_items.menu_id = %s and orders.payment_status <> 0)",
@@ -708,6 +857,7 @@ def delete_menu():
                            "error": "Unable to Delete Item as Customers are still ordering it. Please try again later."}, ValidationError
             cur.execute("update menu set active_menu = 1 where id = %s", menu_id)
             conn.commit()
+            menu_cache.invalidate(restaurant['id'])
             return {"success": "Successfully Deleted the Menu."}
     except KeyError:
         return {"error": "Some Fields Missing"}, ValidationError
@@ -715,6 +865,16 @@ def delete_menu():
         return {"error": "Invalid Request"}, ValidationError
 
 
+# paid orders only. explain_report explains this query
+OrderHistoryQuery = (
+    "Select orders.id, orders.price_excluding_tax, orders.tax, orders.total, orders.time_and_date, users.name "
+    "from orders "
+    "join users on users.id = orders.user_id "
+    "where (orders.restaurant_id = %(restaurant_id)s and orders.payment_status = 0)"
+    "order by orders.time_and_date desc"
+)
+
+
 @admin.route("/order_history", methods=["POST"])
 def order_history():
     """
@@ -731,13 +891,15 @@ def order_history():
             "name": "Sarvesh Joshi",
             "price_excluding_tax": "1980.00",
             "tax": "465.30",
+            "total": "2445.30",
             "time_and_date": "Sun, 06 Jun 2021 19:56:01 GMT"
         },
         {
             "id": "6149bfa4-07ef-47b1-bfa9-55ee1908765a",
             "name": "Sarvesh Joshi",
             "price_excluding_tax": "6660.00",
-            "tax": "None",
+            "tax": "333.00",
+            "total": "6993.00",
             "time_and_date": "Sat, 05 Jun 2021 21:04:52 GMT"
         }
     ]
@@ -750,23 +912,15 @@ def order_history():
         if not request.json:
             return {'error': "JSON Data not Found."}, ValidationError
         restaurant_id = request.json["restaurant_id"]
-        with connection() as conn, conn.cursor(pymysql.cursors.DictCursor) as curr:
-            curr.execute("Select admin_id from restaurant where id=%s", restaurant_id)
-            if not admin_id == curr.fetchone()['admin_id']:
+        with connection(readonly=True, key=admin_id) as conn, conn.cursor(pymysql.cursors.DictCursor) as curr:
+            if not restaurant_cache.is_owner(conn, restaurant_id, admin_id):
                 return {"error": "Requesting Admin and Menu Pair doesn't exists."}, ValidationError
-            curr.execute(
-                "Select orders.id, orders.price_excluding_tax, orders.tax, orders.time_and_date, users.name "
-                "from orders "
-                "join restaurant on orders.restaurant_id = restaurant.id "
-                "join users on users.id = orders.user_id "
-                "where (restaurant.id = %s and orders.payment_status = 0)"
-                "order by orders.time_and_date desc",
-                restaurant_id
-            )
+            curr.execute(OrderHistoryQuery, {'restaurant_id': restaurant_id})
             order_history = curr.fetchall()
             for orders in order_history:
                 orders["price_excluding_tax"] = str(orders["price_excluding_tax"])
                 orders["tax"] = str(orders["tax"])
+                orders["total"] = str(orders["total"])
                 time_and_date_in_IST = orders['time_and_date'].astimezone(timezone('Asia/Kolkata'))
                 orders["time_and_date"] = time_and_date_in_IST.strftime("%I:%M %p %d/%m/%Y")
 
@@ -803,7 +957,8 @@ def detailed_order(order_id):
                 "overall_information": {
                     "name": "Sarvesh Joshi",
                     "price_excluding_tax": "6660.00",
-                    "tax": "None",
+                    "tax": "333.00",
+                    "total": "6993.00",
                     "time_and_date": "Sat, 05 Jun 2021 21:04:52 GMT"
                 }
                 }
@@ -821,11 +976,12 @@ def detailed_order(order_id):
             if admin_id != cur.fetchone()['admin_id']:
                 return {"error": "Unauthorized Request"}, ValidationError
             cur.execute(
-                "Select users.name, orders.time_and_date,orders.price_excluding_tax, orders.tax from users join orders on orders.user_id = users.id where orders.id = %s",
+                "Select users.name, orders.time_and_date,orders.price_excluding_tax, orders.tax, orders.total from users join orders on orders.user_id = users.id where orders.id = %s",
                 order_id)
             overall_information = cur.fetchone()
             overall_information['price_excluding_tax'] = str(overall_information['price_excluding_tax'])
             overall_information['tax'] = str(overall_information['tax'])
+            overall_information['total'] = str(overall_information['total'])
             cur.execute(
                 "Select menu.name, menu.price, order_items.quantity from menu join order_items on menu.id = order_items.menu_id where order_items.order_id = %s ",
                 order_id)
@@ -846,10 +1002,12 @@ def new_orders():
     (Admin Authenticated)
     Sample Input:
     {
-        "restaurant_id" : 1
+        "restaurant_id" : 1,
+        "since": 41             (optional, the cursor of the previous response)
     }
     Sample Output:
     {
+        "cursor": 42,
         "new_orders": {
             "table 1": {
                 "orders": [
@@ -867,49 +1025,110 @@ def new_orders():
             }
         }
     }
+    With "since" only the items ordered after that cursor are in new_orders,
+    and the ids of the items delivered after it are added -
+    {
+        "cursor": 43,
+        "new_orders": {},
+        "delivered": ["0252dbf9-b4c1-4dab-9141-01aa62521e7b"]
+    }
+    A response without "delivered" is the whole board.
     """
     try:
         admin_id = authenticate(request)
         if not admin_id:
             return {"error": "User Authentication Failed"}, ValidationError
         restaurant_id = request.json['restaurant_id']
-        with connection() as conn, conn.cursor(pymysql.cursors.DictCursor) as cur:
-            cur.execute("Select admin_id from restaurant where id = %s", restaurant_id)
-            if cur.fetchone()['admin_id'] != admin_id:
+        since = request.json.get('since')
+        with connection() as conn:
+            if not restaurant_cache.is_owner(conn, restaurant_id, admin_id):
                 return {"error": "Unauthorized Request."}, ValidationError
-            cur.execute(
-                "Select new_orders.id, menu.name, menu.description, new_orders.quantity, orders.table_id, "
-                "users.name, tables.name, orders.id "
-                "from new_orders "
-                "join menu on new_orders.menu_id = menu.id "
-                "join orders on orders.id = new_orders.order_id "
-                "join tables on tables.id = orders.table_id "
-                "join users on orders.user_id = users.id "
-                "where orders.restaurant_id = %s and new_orders.delivered_items = 1 "
-                "order by orders.time_and_date",
-                restaurant_id
-            )
-            yet_to_deliver = cur.fetchall()
-            for ytd in yet_to_deliver:
-                ytd["quantity"] = str(ytd["quantity"])
-
-            table_wise_orders = {}
-
-            for order in yet_to_deliver:
-                orders_by_table = table_wise_orders.get(order['tables.name'], {})
-                orders = orders_by_table.get('orders', [])
-                orders.append(order)
-                orders_by_table['orders'] = orders
-                orders_by_table['users.name'] = order['users.name']
-                table_wise_orders[order['tables.name']] = orders_by_table
-
-            return {"new_orders": table_wise_orders}
+            if since is not None:
+                changes = kitchen.load_changes(conn, restaurant_id, int(since))
+                if changes is not None:
+                    return changes
+            return kitchen.load_board(conn, restaurant_id)
     except KeyError:
         return {"error": "Important Data is missing."}, ValidationError
-    except TypeError:
+    except (TypeError, ValueError):
         return {"error": "Invalid Inputs."}, ValidationError
 
 
+@admin.route("/kitchen_stream_ticket", methods=["POST"])
+def kitchen_stream_ticket():
+    """
+    (Admin Authenticated)
+    A ticket to open the kitchen_stream of the restaurant with.
+    Sample Input :
+    {
+        restaurant_id: id
+    }
+    Sample output :
+    {
+        "ticket": "<ticket>"
+    }
+    """
+    admin_id = authenticate(request)
+    if not admin_id:
+        return {"error": "User Authentication Failed."}, ValidationError
+    if not request.json:
+        return {'error': "JSON Data not Found."}, ValidationError
+
+    restaurant_id = request.json.get('restaurant_id')
+    if not restaurant_cache.is_owner(None, restaurant_id, admin_id):
+        return {"error": "Unauthorized Request."}, ValidationError
+
+    ticket = jwt.encode(
+        {'restaurant_id': restaurant_id, 'purpose': 'kitchen_stream',
+         'exp': int(time.time()) + kitchen_stream_ticket_ttl},
+        jwt_secret, algorithm='HS256'
+    )
+    return {'ticket': ticket}
+
+
+def _stream_restaurant(ticket):
+    """The restaurant a kitchen_stream ticket is for, None if it is not valid (any more)"""
+    try:
+        claims = jwt.decode(ticket, jwt_secret, algorithms=['HS256'])
+    except jwt.exceptions.InvalidTokenError:
+        return None
+    if claims.get('purpose') != 'kitchen_stream':
+        return None
+    return claims.get('restaurant_id')
+
+
+@admin.route("/kitchen_stream", methods=["GET"])
+def kitchen_stream():
+    """
+    Server sent events with the new_orders board of the restaurant, sent when
+    the stream opens and again whenever an item is ordered or delivered.
+    url - /api/v1/admin/kitchen_stream?ticket=<ticket from /kitchen_stream_ticket>
+    EventSource cannot send headers, so the stream is opened with a ticket in
+    the url instead of the jwt. Urls end up in access logs, a ticket only
+    opens this one restaurant's stream and expires after
+    KITCHEN_STREAM_TICKET_TTL seconds. Get a new one to reconnect.
+    Sample event:
+        event: board
+        data: {"new_orders": <same as /new_orders>}
+
+    The stream closes after a few minutes. When the server has too many
+    streams open it answers 503, poll /new_orders then.
+    """
+    restaurant_id = _stream_restaurant(request.args.get('ticket'))
+    if not restaurant_id:
+        return {"error": "Invalid or expired ticket"}, ValidationError
+
+    events = kitchen.stream(restaurant_id)
+    if events is None:
+        return {"error": "Too many open streams. Poll new_orders instead"}, 503
+
+    return Response(events, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # nginx and heroku style proxies would otherwise buffer the events
+        'X-Accel-Buffering': 'no',
+    })
+
+
 @admin.route("/delivered/<id>", methods=["POST"])
 def delivered_menu(id):
     """
@@ -925,22 +1144,23 @@ def delivered_menu(id):
     """
     try:
         admin_id = authenticate(request)
-        restaurant_id = request.json['restaurant_id']
         if not request.json:
             return {"error": "JSON Data is missing"}, ValidationError
-        if not admin:
+        restaurant_id = request.json['restaurant_id']
+        if not admin_id:
             return {"error": "Admin Authentication Failed."}, ValidationError
-        with connection() as conn, conn.cursor(pymysql.cursors.DictCursor) as cur:
-            cur.execute(
-                "Select admin_id from restaurant where id = %s",
-                restaurant_id)
-            if admin_id != cur.fetchone()['admin_id']:
+        with connection() as conn, conn.cursor() as cur:
+            if not restaurant_cache.is_owner(conn, restaurant_id, admin_id):
                 return {"error": "Unauthorized Request."}, ValidationError
-            cur.execute("update new_orders set delivered_items = 0 where id = %s", id)
+            delivered = kitchen.deliver(cur, restaurant_id, id)
             conn.commit()
-            return {"success": "Successfully Delivered Requested Item"}, 200
+            # recent_orders lists the delivered item right away
+            pin_to_primary(admin_id)
+        if delivered:
+            events.publish(events.ItemDelivered(id, restaurant_id))
+        return {"success": "Successfully Delivered Requested Item"}, 200
     except TypeError:
-        return {"error", "Invalid Inputs"}, ValidationError
+        return {"error": "Invalid Inputs"}, ValidationError
     except KeyError:
         return {"error": "JSON Data missing."}, ValidationError
 
@@ -980,25 +1200,13 @@ def recent_orders():
         if not admin_id:
             return {"error": "Admin Authentication Failed."}, ValidationError
         restaurant_id = request.json['restaurant_id']
-        with connection() as conn, conn.cursor(pymysql.cursors.DictCursor) as cur:
-            cur.execute("Select admin_id from restaurant where id = %s", restaurant_id)
-            if cur.fetchone()['admin_id'] != admin_id:
+        with connection(readonly=True, key=admin_id) as conn, conn.cursor(pymysql.cursors.DictCursor) as cur:
+            if not restaurant_cache.is_owner(conn, restaurant_id, admin_id):
                 return {"error": "Unauthorised Request."}, ValidationError
 
             cur.execute(
-                "select users.name ,new_orders.quantity, menu.name, orders.payment_status, "
-                "orders.time_and_date, tables.name, orders.id "
-                "from new_orders "
-                "join menu on new_orders.menu_id = menu.id "
-                "join orders on orders.id = new_orders.order_id "
-                "and orders.id in (select id from orders where payment_status != %s order by time_and_date desc)"
-                "join tables on tables.id = orders.table_id "
-                "join users on users.id = orders.user_id "
-                "where orders.restaurant_id = %s "
-                "and orders.time_and_date > DATE_SUB(CURDATE(), INTERVAL 1 DAY) "
-                "and new_orders.delivered_items = 0 "
-                "order by orders.time_and_date",
-                (paytm.PaymentStatus.SUCCESSFUL, restaurant_id)
+                kitchen.RecentOrdersQuery,
+                {'restaurant_id': restaurant_id, 'paid': paytm.PaymentStatus.SUCCESSFUL.value}
             )
             recent_order = cur.fetchall()
             for ro in recent_order:
@@ -1,8 +1,16 @@
 import logging
 
-from flask import Flask
+from flask import Flask, request
 
 from flask_cors import CORS
+
+import jobs
+import metrics
+import passwords
+from config import metrics_token
+from db_utils import PinHeader, PoolTimeout, log_request_summary, pool_stats, send_pin
+from passwords import PasswordHasherBusy
+from paytm import PaytmUnavailable
 from photos import photos
 from admin_endpoints import admin
 from user_endpoints import user
@@ -13,9 +21,43 @@ app.register_blueprint(user, url_prefix='/api/v1')
 app.register_blueprint(admin, url_prefix='/api/v1/admin')
 app.register_blueprint(photos, url_prefix='/api/v1/photo')
 app.register_blueprint(website)
-CORS(app)
+# browsers only let the page read headers that are listed here
+CORS(app, expose_headers=[PinHeader])
+metrics.init_app(app)
+app.after_request(log_request_summary)
+app.after_request(send_pin)
+
+
+@app.errorhandler(PoolTimeout)
+@app.errorhandler(PasswordHasherBusy)
+def server_busy(e):
+    return {'error': 'Server is busy. Please try again'}, 503
+
+
+@app.errorhandler(PaytmUnavailable)
+def paytm_unavailable(e):
+    return {'error': 'Payments are unavailable right now. Please try again in a minute'}, 503
+
+
+@app.route('/api/v1/metrics')
+def get_metrics():
+    # only for whoever runs the server, not restaurant admins
+    if not metrics_token or request.headers.get('X-Metrics-Token') != metrics_token:
+        return {'error': 'Not found'}, 404
+
+    return {
+        'counters': metrics.counters(),
+        'pools': pool_stats(),
+    }
+
 
 logging.basicConfig(level=logging.DEBUG, format='%(levelname)s %(name)s %(asctime)s %(message)s')
 
+# the bcrypt workers of passwords.py start from a fresh interpreter that imports
+# the script run as __mp_main__, they must not calibrate and start the jobs again
+if __name__ != '__mp_main__':
+    passwords.calibrate()
+    jobs.start()
+
 if __name__ == '__main__':
     app.run(debug=True)
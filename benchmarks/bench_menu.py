@@ -0,0 +1,92 @@
+"""
+Requests per second of /api/v1/menu, with the menu built and json encoded
+per request versus sent as pre-encoded (and pre-gzipped) bytes.
+
+Runs on the sqlite backend in a temporary directory so it needs no database
+server -
+
+    python benchmarks/bench_menu.py [seconds per case]
+
+Both paths hit the menu cache, so this measures only the response building.
+"""
+import os
+import sys
+import tempfile
+import time
+from uuid import uuid4
+
+os.environ['DB_BACKEND'] = 'sqlite'
+os.environ['SQLITE_PATH'] = os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+os.environ.setdefault('JWT_SECRET', 'bench')
+os.environ.setdefault('BCRYPT_ROUNDS', '10')
+# importing app would otherwise start the scheduler and its jobs
+os.environ['BACKGROUND_JOBS'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging  # noqa: E402
+
+import config  # noqa: E402
+import menu_cache  # noqa: E402
+from app import app  # noqa: E402
+from db_utils import connection  # noqa: E402
+
+MenuSizes = [20, 200, 2000]
+
+
+def create_restaurant(items):
+    restaurant_id = str(uuid4())
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            'insert into restaurant(id, name, description, photo_url, tax_percent, admin_id, address, pincode) '
+            'values (%s, %s, %s, %s, %s, %s, %s, %s)',
+            (restaurant_id, 'Bench', 'bench', 'http://example.com/r.jpg', 5, str(uuid4()), 'bench street', '123456')
+        )
+        for i in range(items):
+            cur.execute(
+                'insert into menu(name, description, photo_url, restaurant_id, price) values (%s, %s, %s, %s, %s)',
+                (f'Item {i}', f'Delicious item number {i}', f'http://example.com/{i}.jpg', restaurant_id, 100 + i)
+            )
+        conn.commit()
+    return restaurant_id
+
+
+def requests_per_second(client, restaurant_id, seconds, headers):
+    url = f'/api/v1/menu?restaurant_id={restaurant_id}'
+    # warm the cache
+    client.get(url, headers=headers)
+
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200
+        count += 1
+
+    return count / (time.perf_counter() - started)
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    logging.disable(logging.CRITICAL)
+    client = app.test_client()
+
+    cases = [
+        ('per request json', False, {}),
+        ('pre-encoded', True, {}),
+        ('pre-gzipped', True, {'Accept-Encoding': 'gzip'}),
+    ]
+
+    print(f'{"items":>6} | ' + ' | '.join(f'{name:>18}' for name, _, _ in cases))
+    for size in MenuSizes:
+        restaurant_id = create_restaurant(size)
+        results = []
+        for name, preserialized, headers in cases:
+            config.menu_preserialized = preserialized
+            menu_cache.invalidate(restaurant_id)
+            results.append(requests_per_second(client, restaurant_id, seconds, headers))
+
+        print(f'{size:>6} | ' + ' | '.join(f'{rps:>14.0f} r/s' for rps in results))
+
+
+if __name__ == '__main__':
+    main()
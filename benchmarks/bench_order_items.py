@@ -0,0 +1,108 @@
+"""
+Time to write a basket in /api/v1/order_items, with two statements per item
+(how it used to be done) versus the multi row statements of
+user_endpoints.insert_order_items, for growing basket sizes.
+
+Runs on the sqlite backend in a temporary directory so it needs no database
+server. Every statement is delayed by SQLITE_LATENCY_MS (1ms unless set) to
+stand in for the round trip to a real one -
+
+    python benchmarks/bench_order_items.py [repeats per case]
+"""
+import os
+import sys
+import tempfile
+import time
+from uuid import uuid4
+
+os.environ['DB_BACKEND'] = 'sqlite'
+os.environ['SQLITE_PATH'] = os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+os.environ.setdefault('SQLITE_LATENCY_MS', '1')
+os.environ.setdefault('JWT_SECRET', 'bench')
+os.environ.setdefault('BCRYPT_ROUNDS', '10')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # noqa: E402
+from db_utils import connection  # noqa: E402
+from user_endpoints import Order, insert_order_items  # noqa: E402
+
+BasketSizes = [1, 5, 10, 20]
+
+
+def insert_order_items_per_item(cur, order_id, restaurant_id, all_orders, tax_percent):
+    for order in all_orders:
+        cur.execute(
+            "insert into order_items(order_id, menu_id, quantity, price) values "
+            "(%s,%s,%s,%s) on duplicate key "
+            "update quantity = quantity + %s, price = price + %s ",
+            (order.order_id, order.menu_id, order.quantity,
+             order.price, order.quantity, order.price)
+        )
+        cur.execute("insert into new_orders(id, order_id, menu_id, quantity) values(%s,%s,%s,%s)",
+                    (str(uuid4()), order.order_id, order.menu_id, order.quantity))
+    price_excluding_tax = sum(map(lambda o: o.price, all_orders))
+
+    cur.execute("update orders set price_excluding_tax = price_excluding_tax + %s where id = %s",
+                (price_excluding_tax, order_id))
+
+
+def create_restaurant(items):
+    restaurant_id = str(uuid4())
+    latency, config.sqlite_latency = config.sqlite_latency, 0
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            'insert into restaurant(id, name, description, photo_url, tax_percent, admin_id, address, pincode) '
+            'values (%s, %s, %s, %s, %s, %s, %s, %s)',
+            (restaurant_id, 'Bench', 'bench', 'http://example.com/r.jpg', 5, str(uuid4()), 'bench street', '123456')
+        )
+        cur.executemany(
+            'insert into menu(name, description, photo_url, restaurant_id, price) values (%s, %s, %s, %s, %s)',
+            [(f'Item {i}', 'bench', 'http://example.com/i.jpg', restaurant_id, 100 + i) for i in range(items)]
+        )
+        cur.execute('select id from menu where restaurant_id = %s', (restaurant_id,))
+        menu_ids = list(map(lambda row: row[0], cur.fetchall()))
+        conn.commit()
+    config.sqlite_latency = latency
+    return restaurant_id, menu_ids
+
+
+def milliseconds_per_basket(insert, restaurant_id, menu_ids, size, repeats):
+    elapsed = 0
+    with connection() as conn:
+        for _ in range(repeats):
+            order_id = str(uuid4())
+            with conn.cursor() as cur:
+                cur.execute(
+                    'insert into orders(id, user_id, restaurant_id, table_id, payment_status, '
+                    'price_excluding_tax, tax, total) '
+                    'values (%s, %s, %s, %s, %s, 0, 0, 0)',
+                    (order_id, str(uuid4()), restaurant_id, 1, 1)
+                )
+                all_orders = [Order(order_id, menu_id, 2, 200) for menu_id in menu_ids[:size]]
+
+                started = time.perf_counter()
+                insert(cur, order_id, restaurant_id, all_orders, 5)
+                conn.commit()
+                elapsed += time.perf_counter() - started
+
+    return elapsed / repeats * 1000
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    restaurant_id, menu_ids = create_restaurant(max(BasketSizes))
+
+    cases = [
+        ('per item', insert_order_items_per_item),
+        ('multi row', insert_order_items),
+    ]
+
+    print(f'simulated round trip: {config.sqlite_latency * 1000:g}ms')
+    print(f'{"items":>6} | ' + ' | '.join(f'{name:>12}' for name, _ in cases))
+    for size in BasketSizes:
+        results = [milliseconds_per_basket(insert, restaurant_id, menu_ids, size, repeats) for _, insert in cases]
+        print(f'{size:>6} | ' + ' | '.join(f'{ms:>9.2f} ms' for ms in results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import threading
+import time
+
+import metrics
+
+
+class CircuitOpen(Exception):
+    """Raised instead of making a call while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """
+    Stops calling a remote service that keeps failing.
+
+    After `failure_threshold` failures in a row the breaker opens and every
+    call fails right away with CircuitOpen. After `reset_timeout` seconds
+    one call is let through to try the service again. If it works the
+    breaker closes, otherwise it stays open for another `reset_timeout`.
+
+    Counted in metrics as `<name>.opened` and `<name>.rejected`, the
+    `<name>.open` gauge is 1 while it is open.
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def _rejecting(self):
+        return self._opened_at is not None and (
+            self._trial_running or time.monotonic() - self._opened_at < self.reset_timeout)
+
+    def is_open(self):
+        """True while a call would fail right away with CircuitOpen"""
+        with self._lock:
+            return self._rejecting()
+
+    def _before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+
+            if self._rejecting():
+                metrics.incr(self.name + '.rejected')
+                raise CircuitOpen(f'{self.name} is unavailable')
+
+            self._trial_running = True
+
+    def _after_call(self, failed):
+        with self._lock:
+            self._trial_running = False
+
+            if not failed:
+                self._failures = 0
+                if self._opened_at is not None:
+                    self._opened_at = None
+                    metrics.gauge(self.name + '.open', 0)
+                return
+
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    metrics.incr(self.name + '.opened')
+                    metrics.gauge(self.name + '.open', 1)
+                self._opened_at = time.monotonic()
+
+    def call(self, fn, *args, failure=Exception):
+        """
+        Calls fn(*args). Exceptions of type `failure` count as failures of
+        the service, anything else is passed on without counting.
+        """
+        self._before_call()
+
+        try:
+            result = fn(*args)
+        except failure:
+            self._after_call(failed=True)
+            raise
+        except BaseException:
+            self._after_call(failed=False)
+            raise
+
+        self._after_call(failed=False)
+        return result
@@ -15,3 +15,110 @@ merchant_key = os.getenv('MERCHANT_KEY')
 
 website = os.getenv('WEBSITE')
 callback_url = os.getenv('CALLBACK_URL')
+
+# connection pool. size is per worker process
+pool_size = int(os.getenv('DB_POOL_SIZE', '10'))
+# seconds to wait for a free connection before giving up
+pool_timeout = float(os.getenv('DB_POOL_TIMEOUT', '5'))
+# seconds after which a connection is closed and replaced
+pool_recycle = float(os.getenv('DB_POOL_RECYCLE', '1800'))
+
+# comma separated list of read replica hosts. Empty means all reads go to DB_HOSTNAME
+replica_hosts = [h.strip() for h in os.getenv('DB_REPLICA_HOSTNAMES', '').split(',') if h.strip()]
+# seconds for which a user's reads stay on the primary after they write. The
+# process that took the write remembers it, other processes only know when the
+# client sends back the signed X-Read-Primary-Until header or cookie it was given
+read_your_writes_window = float(os.getenv('DB_READ_YOUR_WRITES_WINDOW', '10'))
+
+# statements slower than this many seconds are logged with their explain plan
+slow_query_threshold = float(os.getenv('SLOW_QUERY_THRESHOLD', '0.2'))
+
+# token required in X-Metrics-Token to read /api/v1/metrics. Unset disables it
+metrics_token = os.getenv('METRICS_TOKEN')
+
+# mysql, or sqlite to run everything locally without a database server
+db_backend = os.getenv('DB_BACKEND', 'mysql')
+# database file used when DB_BACKEND is sqlite
+sqlite_path = os.getenv('SQLITE_PATH', 'fine_dine.sqlite3')
+
+# how many verified jwt tokens to remember, and for how many seconds
+jwt_cache_size = int(os.getenv('JWT_CACHE_SIZE', '10000'))
+jwt_cache_ttl = float(os.getenv('JWT_CACHE_TTL', '300'))
+
+# password hashing processes per server process, and how many hashes may wait for one
+bcrypt_workers = int(os.getenv('BCRYPT_WORKERS', '2'))
+bcrypt_queue_size = int(os.getenv('BCRYPT_QUEUE_SIZE', '16'))
+# fixed bcrypt work factor. When unset it is calibrated at startup so that
+# one hash takes about BCRYPT_TARGET_SECONDS
+bcrypt_rounds = int(os.getenv('BCRYPT_ROUNDS')) if os.getenv('BCRYPT_ROUNDS') else None
+bcrypt_target_seconds = float(os.getenv('BCRYPT_TARGET_SECONDS', '0.25'))
+
+# restaurant owner, tax and tables cache
+restaurant_cache_size = int(os.getenv('RESTAURANT_CACHE_SIZE', '1000'))
+restaurant_cache_ttl = float(os.getenv('RESTAURANT_CACHE_TTL', '60'))
+
+# how long to remember whether an email domain accepts mail, in seconds
+email_domain_cache_size = int(os.getenv('EMAIL_DOMAIN_CACHE_SIZE', '10000'))
+email_domain_cache_ttl = float(os.getenv('EMAIL_DOMAIN_CACHE_TTL', '86400'))
+email_domain_negative_ttl = float(os.getenv('EMAIL_DOMAIN_NEGATIVE_TTL', '3600'))
+email_dns_timeout = float(os.getenv('EMAIL_DNS_TIMEOUT', '3'))
+
+# per restaurant menu cache. Other server processes see menu changes after the ttl
+menu_cache_size = int(os.getenv('MENU_CACHE_SIZE', '1000'))
+menu_cache_ttl = float(os.getenv('MENU_CACHE_TTL', '300'))
+
+# seconds clients and proxies may reuse menu and table responses without asking again
+http_cache_max_age = int(os.getenv('HTTP_CACHE_MAX_AGE', '10'))
+
+# keep each menu response encoded as json (and gzip) bytes instead of encoding it per request
+menu_preserialized = os.getenv('MENU_PRESERIALIZED', '1') == '1'
+menu_pregzip = os.getenv('MENU_PREGZIP', '1') == '1'
+# seconds added to every sqlite statement to simulate a network round trip
+sqlite_latency = float(os.getenv('SQLITE_LATENCY_MS', '0')) / 1000
+
+# how long the response to a request with an Idempotency-Key is kept for retries
+idempotency_key_ttl = int(os.getenv('IDEMPOTENCY_KEY_TTL', '86400'))
+idempotency_cache_size = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', '10000'))
+
+# run the periodic jobs in jobs.py in this process
+background_jobs = os.getenv('BACKGROUND_JOBS', '1') == '1'
+
+# background reconciliation of payments whose client never reported back
+reconcile_payments = os.getenv('RECONCILE_PAYMENTS', '1') == '1'
+# seconds between runs
+reconcile_interval = int(os.getenv('RECONCILE_INTERVAL', '60'))
+# transactions younger than this may still be being paid, they are left alone
+reconcile_min_age = int(os.getenv('RECONCILE_MIN_AGE', '900'))
+# seconds before a transaction that is still pending is asked about again
+reconcile_recheck = int(os.getenv('RECONCILE_RECHECK', '300'))
+reconcile_batch_size = int(os.getenv('RECONCILE_BATCH_SIZE', '100'))
+reconcile_workers = int(os.getenv('RECONCILE_WORKERS', '4'))
+# paytm status calls per second, across all reconcile workers of the process
+reconcile_rate = float(os.getenv('RECONCILE_RATE', '5'))
+
+# paytm calls. Seconds to connect, and to wait for the answer
+paytm_connect_timeout = float(os.getenv('PAYTM_CONNECT_TIMEOUT', '3'))
+paytm_read_timeout = float(os.getenv('PAYTM_READ_TIMEOUT', '10'))
+paytm_status_read_timeout = float(os.getenv('PAYTM_STATUS_READ_TIMEOUT', '5'))
+# failures in a row before paytm is not called for paytm_reset_timeout seconds
+paytm_failure_threshold = int(os.getenv('PAYTM_FAILURE_THRESHOLD', '5'))
+paytm_reset_timeout = float(os.getenv('PAYTM_RESET_TIMEOUT', '30'))
+# talk to this server instead of paytm, e.g. http://localhost:8085 for fake_paytm.py
+paytm_base_url = os.getenv('PAYTM_BASE_URL')
+
+# kitchen_stream (server sent events for the kitchen board)
+# seconds between checks for board changes made by other processes
+kitchen_poll_interval = float(os.getenv('KITCHEN_POLL_INTERVAL', '1'))
+# open streams per process. Each one holds a server thread, so keep it well below
+# the gunicorn --threads in the Procfile. Tablets past this poll /admin/new_orders
+kitchen_stream_max = int(os.getenv('KITCHEN_STREAM_MAX', '16'))
+# seconds before a stream is closed and the browser reconnects
+kitchen_stream_duration = float(os.getenv('KITCHEN_STREAM_DURATION', '300'))
+# seconds between keep alive comments on an idle stream
+kitchen_stream_heartbeat = float(os.getenv('KITCHEN_STREAM_HEARTBEAT', '15'))
+kitchen_board_cache_size = int(os.getenv('KITCHEN_BOARD_CACHE_SIZE', '1000'))
+# seconds a kitchen_stream ticket can be used to open the stream
+kitchen_stream_ticket_ttl = int(os.getenv('KITCHEN_STREAM_TICKET_TTL', '30'))
+
+# events each subscriber of events.py may have waiting before new ones are dropped for it
+event_queue_size = int(os.getenv('EVENT_QUEUE_SIZE', '1000'))
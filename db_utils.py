@@ -1,14 +1,473 @@
+import hashlib
+import hmac
+import itertools
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+
 import pymysql
 from contextlib2 import contextmanager
+from flask import g, has_request_context, request
+
+import metrics
+import sqlite_backend
+
+from config import username, password, hostname, database, pool_size, pool_timeout, pool_recycle, \
+    replica_hosts, read_your_writes_window, slow_query_threshold, db_backend, sqlite_path, jwt_secret
+
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger('slow_queries')
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out within the pool timeout"""
+
+
+class _PooledConnection:
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+
+
+class ConnectionPool:
+    """
+    A bounded, thread safe pool of mysql connections.
+
+    At most `size` connections are open at a time. Idle connections are
+    pinged before being handed out and are closed once they are older than
+    `recycle` seconds, so a connection dropped by mysql (wait_timeout) or
+    by the network never reaches an endpoint. `errors` are the exceptions
+    that mean a connection is broken.
+    """
+
+    def __init__(self, connect, size, timeout, recycle, errors=pymysql.Error):
+        self._connect = connect
+        self._errors = errors
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+
+        self._idle = deque()
+        self._open = 0
+        self._lock = threading.Condition()
+
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'created': 0,
+            'recycled': 0,
+            'failed_health_checks': 0,
+            'discarded': 0,
+        }
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                self._stats,
+                size=self.size,
+                open=self._open,
+                idle=len(self._idle),
+                in_use=self._open - len(self._idle),
+            )
+
+    def checkout(self):
+        deadline = time.monotonic() + self.timeout
+
+        with self._lock:
+            while not self._idle and self._open >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(f'no database connection available after {self.timeout} seconds')
+
+                self._stats['waits'] += 1
+                self._lock.wait(remaining)
+
+            self._stats['checkouts'] += 1
+
+            if self._idle:
+                pooled = self._idle.pop()
+            else:
+                # reserve the slot before connecting so that other threads
+                # do not overshoot the pool size while we are connecting
+                self._open += 1
+                pooled = None
+
+        if pooled is None:
+            return self._create()
+
+        if self._healthy(pooled):
+            return pooled
+
+        # the replacement takes over the slot, giving it back in between
+        # would let a waiting thread open one more connection than `size`
+        self._disconnect(pooled)
+        return self._create()
+
+    def checkin(self, pooled, discard=False):
+        if not discard:
+            try:
+                # anything the endpoint did not commit is thrown away just
+                # like it was when every request closed its own connection
+                pooled.conn.rollback()
+            except self._errors:
+                discard = True
+
+        if discard:
+            with self._lock:
+                self._stats['discarded'] += 1
+            self._close(pooled)
+            return
+
+        with self._lock:
+            self._idle.append(pooled)
+            self._lock.notify()
+
+    def _healthy(self, pooled):
+        if time.monotonic() - pooled.created_at > self.recycle:
+            with self._lock:
+                self._stats['recycled'] += 1
+            return False
+
+        try:
+            pooled.conn.ping(reconnect=False)
+            return True
+        except self._errors:
+            with self._lock:
+                self._stats['failed_health_checks'] += 1
+            return False
+
+    def _create(self):
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._lock:
+                self._open -= 1
+                self._lock.notify()
+            raise
+
+        with self._lock:
+            self._stats['created'] += 1
+        return _PooledConnection(conn)
+
+    def _disconnect(self, pooled):
+        """Closes the connection but keeps its slot"""
+        try:
+            pooled.conn.close()
+        except self._errors:
+            pass
+
+    def _close(self, pooled):
+        self._disconnect(pooled)
+
+        with self._lock:
+            self._open -= 1
+            self._lock.notify()
+
+
+def normalize(statement):
+    """Collapses whitespace and case so that the same query always looks the same"""
+    return re.sub(r'\s+', ' ', statement).strip().lower()
+
+
+# normalized statement -> monotonic time of the last EXPLAIN we ran for it
+_explained_at = {}
+# explain a slow statement at most this often, a slow query running on
+# every request should not also make every request run an extra EXPLAIN
+_explain_interval = 300
+
+
+def _explain(conn, statement, args):
+    normalized = normalize(statement)
+    now = time.monotonic()
+    if now - _explained_at.get(normalized, -_explain_interval) < _explain_interval:
+        return None
+    _explained_at[normalized] = now
+
+    if not normalized.startswith(('select', 'update', 'delete', 'insert')):
+        return None
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute('explain ' + statement, args)
+            columns = [column[0] for column in cur.description]
+            return [dict(zip(columns, row)) for row in cur.fetchall()]
+    except pymysql.Error as e:
+        return f'explain failed: {e}'
+
+
+def _record_query(conn, statement, args, duration, rowcount):
+    normalized = normalize(statement)
+    endpoint = request.endpoint if has_request_context() else None
+
+    metrics.observe('db', duration)
+
+    if has_request_context():
+        queries = g.setdefault('db_queries', [])
+        queries.append((duration, normalized, rowcount))
+
+    if duration >= slow_query_threshold:
+        slow_query_logger.warning(
+            'slow query (%.1f ms, %s rows) from %s: %s explain: %s',
+            duration * 1000, rowcount, endpoint, normalized, _explain(conn, statement, args),
+        )
+
+
+def request_summary():
+    """Query count, total db time and the slowest statement of the current request"""
+    queries = g.get('db_queries', [])
+    if not queries:
+        return {'queries': 0, 'db_time': 0.0, 'slowest': None}
+
+    slowest = max(queries, key=lambda q: q[0])
+    return {
+        'queries': len(queries),
+        'db_time': sum(q[0] for q in queries),
+        'slowest': {'statement': slowest[1], 'duration': slowest[0], 'rowcount': slowest[2]},
+    }
+
+
+def log_request_summary(response):
+    if g.get('db_queries'):
+        summary = request_summary()
+        logger.info(
+            '%s: %d queries, %.1f ms in db, slowest %.1f ms: %s',
+            request.endpoint, summary['queries'], summary['db_time'] * 1000,
+            summary['slowest']['duration'] * 1000, summary['slowest']['statement'],
+        )
+    return response
+
+
+class InstrumentedCursor:
+    """Wraps a pymysql cursor and times every statement executed through it"""
+
+    def __init__(self, conn, cursor):
+        self._conn = conn
+        self._cursor = cursor
+
+    def execute(self, query, args=None):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(query, args)
+        finally:
+            _record_query(self._conn, query, args, time.perf_counter() - started, self._cursor.rowcount)
 
-from config import username, password, hostname, database
+    def executemany(self, query, args):
+        started = time.perf_counter()
+        try:
+            return self._cursor.executemany(query, args)
+        finally:
+            _record_query(self._conn, query, args[0] if args else None, time.perf_counter() - started, self._cursor.rowcount)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._cursor.close()
+
+
+class InstrumentedConnection:
+    """Hands out InstrumentedCursors, everything else goes to the real connection"""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self, cursor=None):
+        return InstrumentedCursor(self._conn, self._conn.cursor(cursor))
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class MysqlBackend:
+    """
+    A backend is anything with connect(host) returning a pymysql compatible
+    connection. `host` is the primary or one of the replicas. `errors` are
+    the exceptions its connections raise.
+    """
+    errors = pymysql.Error
+
+    def connect(self, host):
+        return pymysql.connect(user=username, password=password, host=host, database=database)
+
+
+class SqliteBackend:
+    errors = sqlite_backend.Errors
+
+    def connect(self, host):
+        # there is only one sqlite file, replicas read from it as well
+        return sqlite_backend.connect(sqlite_path)
+
+
+backends = {
+    'mysql': MysqlBackend,
+    'sqlite': SqliteBackend,
+}
+
+try:
+    backend = backends[db_backend]()
+except KeyError:
+    raise ValueError(f'DB_BACKEND must be one of {", ".join(backends)}, not {db_backend}')
+
+
+def _connect(host):
+    return backend.connect(host)
+
+
+_pools = {}
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(host=hostname):
+    global _pools, _pool_pid
+
+    # gunicorn forks workers after importing the app. Sockets must not be
+    # shared between processes, so every process builds its own pools.
+    if _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool_pid != os.getpid():
+                _pools = {}
+                _pool_pid = os.getpid()
+
+    pool = _pools.get(host)
+    if pool is None:
+        with _pool_lock:
+            pool = _pools.get(host)
+            if pool is None:
+                pool = ConnectionPool(lambda: _connect(host), pool_size, pool_timeout, pool_recycle, backend.errors)
+                _pools[host] = pool
+
+    return pool
+
+
+def pool_stats():
+    return {host: pool.stats() for host, pool in _pools.items()}
+
+
+# key (usually a user id) -> time until which its reads go to the primary
+_pinned_until = {}
+_replica_counter = itertools.count()
+
+# the next request of a client may reach another process, which doesn't know
+# about the pin. So the end of the pin (unix time) is also sent back to the
+# client with this header and cookie, and honoured when the client sends it.
+# It is signed, a client can't make up pins to keep its reads on the primary
+PinHeader = 'X-Read-Primary-Until'
+PinCookie = 'read_primary_until'
+
+
+def pin_to_primary(key):
+    """
+    Sends readonly connections for `key` to the primary for the next
+    `read_your_writes_window` seconds. Call this after committing a write
+    that the same user is likely to read back immediately, so that replica
+    lag does not make their order disappear.
+    """
+    if not key or not replica_hosts:
+        return
+
+    if has_request_context():
+        g.read_primary_until = time.time() + read_your_writes_window
+
+    now = time.monotonic()
+    _pinned_until[key] = now + read_your_writes_window
+
+    # forget expired pins once in a while so the dict doesn't keep growing
+    if len(_pinned_until) > 10000:
+        for k, until in list(_pinned_until.items()):
+            if until < now:
+                _pinned_until.pop(k, None)
+
+
+def _pin_signature(until):
+    return hmac.new(jwt_secret.encode('utf-8'), until.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def _signed_pin(until):
+    until = '%.3f' % until
+    return until + ':' + _pin_signature(until)
+
+
+def _pinned_by_client():
+    value = request.headers.get(PinHeader) or request.cookies.get(PinCookie)
+    if not value or ':' not in value:
+        return False
+
+    until, signature = value.split(':', 1)
+    if not hmac.compare_digest(signature, _pin_signature(until)):
+        return False
+    try:
+        until = float(until)
+    except ValueError:
+        return False
+
+    # never further ahead than a write of ours could have pinned it
+    now = time.time()
+    return now < until <= now + read_your_writes_window
+
+
+def _pinned(key):
+    if has_request_context() and _pinned_by_client():
+        return True
+
+    until = _pinned_until.get(key) if key else None
+    return until is not None and until > time.monotonic()
+
+
+def send_pin(response):
+    """after_request hook that hands the pin of this request's write to the client"""
+    until = g.get('read_primary_until')
+    if until is not None:
+        pin = _signed_pin(until)
+        response.headers[PinHeader] = pin
+        response.set_cookie(PinCookie, pin, max_age=int(read_your_writes_window) + 1)
+    return response
+
+
+def _checkout(readonly, key):
+    if readonly and replica_hosts and not _pinned(key):
+        # round robin, starting from a different replica every time. A replica
+        # that cannot be reached is skipped and the primary is the last resort
+        start = next(_replica_counter)
+        for i in range(len(replica_hosts)):
+            pool = get_pool(replica_hosts[(start + i) % len(replica_hosts)])
+            try:
+                return pool, pool.checkout()
+            except (pymysql.OperationalError, PoolTimeout) as e:
+                logger.warning('replica unavailable: %s', e)
+
+    pool = get_pool()
+    return pool, pool.checkout()
 
 
 @contextmanager
-def connection():
-    conn = pymysql.connect(user=username, password=password, host=hostname, database=database)
+def connection(readonly=False, key=None):
+    """
+    Yields a pooled connection to the primary.
+
+    With readonly=True the connection may come from one of the read
+    replicas instead, unless `key` was recently passed to pin_to_primary().
+    Never write through a readonly connection.
+    """
+    pool, pooled = _checkout(readonly, key)
 
+    discard = False
     try:
-        yield conn
+        yield InstrumentedConnection(pooled.conn)
+    except (pymysql.OperationalError, pymysql.InterfaceError):
+        # the connection itself is probably broken, don't give it to anyone else
+        discard = True
+        raise
     finally:
-        conn.close()
+        pool.checkin(pooled, discard)
@@ -0,0 +1,59 @@
+"""
+Email validation that keeps dns lookups off the login path.
+
+validate_email() from email_validator checks by default that the domain
+accepts mail, which is a dns lookup on every call. Logging in only needs the
+address to be well formed (the lookup in users decides the rest), so
+validate_login_email() checks syntax only. Signing up and changing an email
+still check deliverability, but the answer for each domain is cached,
+including "undeliverable" for a shorter time.
+"""
+import time
+
+from email_validator import EmailUndeliverableError, validate_email, validate_email_deliverability
+
+import config
+import metrics
+from cache import TTLCache
+
+_deliverable_domains = TTLCache('email_domain_cache', config.email_domain_cache_size,
+                                config.email_domain_cache_ttl)
+
+
+def validate_login_email(email):
+    """Returns the normalized email. Raises EmailNotValidError if the syntax is wrong"""
+    return validate_email(email, check_deliverability=False).email
+
+
+def _check_domain(ascii_domain, domain):
+    # either True or the message of the EmailUndeliverableError we got last time
+    result = _deliverable_domains.get(ascii_domain)
+
+    if result is None:
+        started = time.perf_counter()
+        try:
+            answer = validate_email_deliverability(ascii_domain, domain, timeout=config.email_dns_timeout)
+        except EmailUndeliverableError as e:
+            result = str(e)
+            _deliverable_domains.set(ascii_domain, result, config.email_domain_negative_ttl)
+        else:
+            result = True
+            # a resolver timeout tells us nothing about the domain. Let the
+            # address through but ask again next time
+            if 'unknown-deliverability' not in answer:
+                _deliverable_domains.set(ascii_domain, result)
+        finally:
+            metrics.observe('email_dns', time.perf_counter() - started)
+
+    if result is not True:
+        raise EmailUndeliverableError(result)
+
+
+def validate_signup_email(email):
+    """
+    Returns the normalized email. Raises EmailNotValidError if the syntax is
+    wrong or the domain does not accept mail.
+    """
+    validated = validate_email(email, check_deliverability=False)
+    _check_domain(validated.ascii_domain, validated.domain)
+    return validated.email
@@ -0,0 +1,89 @@
+"""
+Order lifecycle events, published by the endpoints once the transaction
+that made the change has committed.
+
+Every subscriber has its own bounded queue and thread, so publish() never
+waits for a subscriber. When a subscriber's queue is full the event is
+dropped for that subscriber and counted. Events are not stored anywhere -
+a subscriber that must not miss a change still has to read the database
+now and then - and a PaymentUpdated can arrive twice when the reconciler
+and the client settle the same payment at once.
+
+Counted in metrics as
+ - events.<event type>: events published
+ - events.<subscriber>.delivered, .dropped and .errors
+ - events.<subscriber>.queued: gauge of the events waiting for the subscriber
+ - events.<subscriber>.lag: seconds from publish() until the subscriber got the event
+"""
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+OrderCreated = namedtuple('OrderCreated', ['order_id', 'restaurant_id', 'user_id', 'table_id'])
+# items is a list of (menu_id, quantity)
+ItemsAdded = namedtuple('ItemsAdded', ['order_id', 'restaurant_id', 'items'])
+CheckoutStarted = namedtuple('CheckoutStarted', ['order_id', 'txn_id', 'amount'])
+# a transaction of the order was settled with payment_status
+PaymentUpdated = namedtuple('PaymentUpdated', ['order_id', 'txn_id', 'payment_status'])
+ItemDelivered = namedtuple('ItemDelivered', ['ticket_id', 'restaurant_id'])
+TableRenamed = namedtuple('TableRenamed', ['table_id', 'restaurant_id', 'name'])
+
+
+class _Subscriber:
+    def __init__(self, name, handler, event_types):
+        self.name = name
+        self.handler = handler
+        self.event_types = event_types
+        self.queue = queue.Queue(config.event_queue_size)
+
+    def run(self):
+        while True:
+            event, published_at = self.queue.get()
+            metrics.observe('events.' + self.name + '.lag', time.monotonic() - published_at)
+            try:
+                self.handler(event)
+            except Exception:
+                metrics.incr('events.' + self.name + '.errors')
+                logger.exception('%s could not handle %s', self.name, event)
+            else:
+                metrics.incr('events.' + self.name + '.delivered')
+
+
+# replaced rather than changed, so publish() can go through it without a lock
+_subscribers = ()
+_lock = threading.Lock()
+
+
+def subscribe(name, handler, *event_types):
+    """
+    Calls handler(event) on a thread of its own for every published event
+    that is one of `event_types`. `name` is used in the metrics.
+    """
+    global _subscribers
+
+    subscriber = _Subscriber(name, handler, event_types)
+    with _lock:
+        _subscribers = _subscribers + (subscriber,)
+    threading.Thread(target=subscriber.run, name='events-' + name, daemon=True).start()
+
+
+def publish(event):
+    """Hands the event to the subscribers of its type. Call after the commit"""
+    metrics.incr('events.' + type(event).__name__)
+    published_at = time.monotonic()
+
+    for subscriber in _subscribers:
+        if not isinstance(event, subscriber.event_types):
+            continue
+        try:
+            subscriber.queue.put_nowait((event, published_at))
+        except queue.Full:
+            metrics.incr('events.' + subscriber.name + '.dropped')
+        metrics.gauge('events.' + subscriber.name + '.queued', subscriber.queue.qsize())
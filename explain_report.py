@@ -0,0 +1,137 @@
+"""
+Prints the EXPLAIN plan of every hot path query.
+
+usage -
+    python explain_report.py            plans against the current schema
+    python explain_report.py --apply    plans, then pending migrations, then plans again
+
+The parameters are taken from the busiest restaurant and user in the
+database so the plans reflect real data distribution.
+"""
+import sys
+
+import admin_endpoints
+import kitchen
+import menu_cache
+import migrate
+import paytm
+import user_endpoints
+from db_utils import connection
+
+# the endpoints' queries before the migrations they now depend on, so that
+# the "before" pass of --apply can still explain what ran then
+_HistoryBefore0006 = (
+    "Select orders.id, restaurant.name, orders.price_excluding_tax+orders.tax, orders.time_and_date,"
+    "restaurant.tax_percent,restaurant.photo_url "
+    "from orders "
+    "join restaurant on orders.restaurant_id = restaurant.id "
+    "where orders.user_id= %(user_id)s "
+    "order by orders.time_and_date desc"
+)
+_AdminHistoryBefore0006 = (
+    "Select orders.id, orders.price_excluding_tax, orders.tax, orders.time_and_date, users.name "
+    "from orders "
+    "join users on users.id = orders.user_id "
+    "where (orders.restaurant_id = %(restaurant_id)s and orders.payment_status = 0)"
+    "order by orders.time_and_date desc"
+)
+_TicketJoins = (
+    "from new_orders "
+    "join menu on new_orders.menu_id = menu.id "
+    "join orders on orders.id = new_orders.order_id "
+    "join tables on tables.id = orders.table_id "
+    "join users on orders.user_id = users.id "
+)
+_BoardBefore0009 = (
+    "Select new_orders.id, menu.name, menu.description, new_orders.quantity, orders.table_id, "
+    "users.name, tables.name, orders.id " + _TicketJoins +
+    "where orders.restaurant_id = %(restaurant_id)s and new_orders.delivered_items = 1 "
+    "order by orders.time_and_date"
+)
+_ChangesBefore0009 = (
+    "Select new_orders.id, menu.name, menu.description, new_orders.quantity, orders.table_id, "
+    "users.name, tables.name, orders.id, new_orders.delivered_items " + _TicketJoins +
+    "where new_orders.restaurant_id = %(restaurant_id)s and new_orders.seq > %(since)s "
+    "and new_orders.seq <= %(cursor)s "
+    "order by new_orders.seq"
+)
+_RecentBefore0009 = (
+    "select users.name ,new_orders.quantity, menu.name, orders.payment_status, "
+    "orders.time_and_date, tables.name, orders.id " + _TicketJoins +
+    "where orders.restaurant_id = %(restaurant_id)s and orders.payment_status != %(paid)s "
+    "and orders.time_and_date > DATE_SUB(CURDATE(), INTERVAL 1 DAY) "
+    "and new_orders.delivered_items = 0 "
+    "order by orders.time_and_date"
+)
+
+# name: [(the migration the query needs, query), ...] newest first. The
+# first form the database has the migration for is explained, None runs on
+# any schema
+HotQueries = {
+    'user get_order_history': [('0006', user_endpoints.OrderHistoryQuery), (None, _HistoryBefore0006)],
+    'admin order_history': [('0006', admin_endpoints.OrderHistoryQuery), (None, _AdminHistoryBefore0006)],
+    'admin new_orders': [('0009', kitchen.BoardQuery), (None, _BoardBefore0009)],
+    'admin new_orders since': [('0009', kitchen.ChangesQuery), ('0008', _ChangesBefore0009)],
+    'admin recent_orders': [('0009', kitchen.RecentOrdersQuery), (None, _RecentBefore0009)],
+    'user get_menu': [(None, menu_cache.MenuQuery)],
+}
+
+
+def sample_parameters(cur):
+    cur.execute('select restaurant_id from orders group by restaurant_id order by count(*) desc limit 1')
+    row = cur.fetchone()
+    restaurant_id = row[0] if row else ''
+
+    cur.execute('select user_id from orders group by user_id order by count(*) desc limit 1')
+    row = cur.fetchone()
+    user_id = row[0] if row else ''
+
+    return {
+        'restaurant_id': restaurant_id,
+        'user_id': user_id,
+        'paid': paytm.PaymentStatus.SUCCESSFUL.value,
+        'since': 0,
+        'cursor': 0,
+    }
+
+
+def report():
+    # the primary, replicas may not have the new indexes yet
+    with connection() as conn, conn.cursor() as cur:
+        applied = migrate.applied_versions(conn)
+        parameters = sample_parameters(cur)
+
+        for name, forms in HotQueries.items():
+            # before --apply the tables or columns of the current query may
+            # not exist yet, explain the one the endpoint used then
+            usable = [form for form in forms if form[0] is None or form[0] in applied]
+            if not usable:
+                print(f'== {name}')
+                print(f'n/a, needs migration {forms[-1][0]}')
+                print()
+                continue
+
+            migration, query = usable[0]
+            cur.execute('explain ' + query, parameters)
+            columns = [column[0] for column in cur.description]
+            rows = cur.fetchall()
+
+            if usable[0] is forms[0]:
+                print(f'== {name}')
+            else:
+                print(f'== {name} (as before migration {forms[0][0]})')
+            print(' | '.join(columns))
+            for row in rows:
+                print(' | '.join(map(str, row)))
+            print()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--apply':
+        print('###### before')
+        report()
+        migrate.migrate()
+        print('###### after')
+        report()
+    else:
+        report()
@@ -0,0 +1,106 @@
+"""
+A stand in for the two paytm apis we use, to load test checkout and payment
+status without paytm.
+
+usage -
+    python fake_paytm.py [--port 8085] [--latency-ms 200] [--jitter-ms 100]
+                         [--error-rate 0.05] [--hang-rate 0.01]
+                         [--status success|pending|failure]
+
+then start the app with PAYTM_BASE_URL=http://localhost:8085
+
+--error-rate is the share of requests answered with a 502 html page like
+a failing load balancer, --hang-rate the share that get no answer for a
+minute so the timeouts and the circuit breaker in paytm.py kick in.
+Responses are not signed, the sdk only checks signatures that are there.
+"""
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+from uuid import uuid4
+
+# resultCode and resultStatus paytm sends for each --status
+Statuses = {
+    'success': ('01', 'TXN_SUCCESS', 'Txn Success'),
+    'pending': ('400', 'PENDING', 'Txn Pending'),
+    'failure': ('227', 'TXN_FAILURE', 'Txn Failure'),
+}
+
+
+class FakePaytm(BaseHTTPRequestHandler):
+    options = None
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        body = request.get('body', {})
+        options = self.options
+
+        delay = max(0, options.latency_ms + random.uniform(-options.jitter_ms, options.jitter_ms)) / 1000
+        time.sleep(delay)
+
+        chance = random.random()
+        if chance < options.hang_rate:
+            time.sleep(60)
+            return self._send(504, b'<html>Gateway Timeout</html>', 'text/html')
+        if chance < options.hang_rate + options.error_rate:
+            return self._send(502, b'<html>Bad Gateway</html>', 'text/html')
+
+        path = urlparse(self.path).path
+        if path == '/order/initiate':
+            response_body = {
+                'resultInfo': {'resultStatus': 'S', 'resultCode': '0000', 'resultMsg': 'Success'},
+                'txnToken': uuid4().hex,
+                'isPromoCodeValid': False,
+                'authenticated': False,
+            }
+        elif path == '/v3/order/status':
+            code, status, message = Statuses[options.status]
+            response_body = {
+                'resultInfo': {'resultStatus': status, 'resultCode': code, 'resultMsg': message},
+                'txnId': uuid4().hex,
+                'orderId': body.get('orderId'),
+                'mid': body.get('mid'),
+            }
+        else:
+            return self._send(404, b'{}', 'application/json')
+
+        response = {
+            'head': {'responseTimestamp': str(int(time.time() * 1000)), 'version': 'v1'},
+            'body': response_body,
+        }
+        # compact like paytm's, the sdk looks for '"body":{' in the raw response
+        self._send(200, json.dumps(response, separators=(',', ':')).encode('utf-8'), 'application/json')
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.options.quiet:
+            super().log_message(format, *args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake paytm server for load tests')
+    parser.add_argument('--port', type=int, default=8085)
+    parser.add_argument('--latency-ms', type=float, default=200)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--hang-rate', type=float, default=0)
+    parser.add_argument('--status', choices=sorted(Statuses), default='success')
+    parser.add_argument('--quiet', action='store_true', help='do not log every request')
+    FakePaytm.options = parser.parse_args()
+
+    server = ThreadingHTTPServer(('', FakePaytm.options.port), FakePaytm)
+    print(f'fake paytm listening on http://localhost:{FakePaytm.options.port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
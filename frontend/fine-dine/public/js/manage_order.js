@@ -1,6 +1,20 @@
 // Global variables
 BASE_URL = "https://fine-dine-backend.onrender.com/api/v1/admin"
 NEW_ORDERS_CLICKED = true
+// items on the kitchen board by id, and the cursor they are current to
+TICKETS = {}
+CURSOR = null
+
+// Reads right after a write have to go to the primary database. The server
+// says until when, send it back with every request
+READ_PRIMARY_UNTIL = null
+$(document).ajaxSend(function(event, xhr) {
+    if (READ_PRIMARY_UNTIL) xhr.setRequestHeader("X-Read-Primary-Until", READ_PRIMARY_UNTIL)
+})
+$(document).ajaxComplete(function(event, xhr) {
+    var until = xhr.getResponseHeader("X-Read-Primary-Until")
+    if (until) READ_PRIMARY_UNTIL = until
+})
 
 function getCookie(name) {
     var nameEQ = name + "=";
@@ -46,6 +60,7 @@ function newItemChecked(e) {
             } else if (response.hasOwnProperty("success")) {
                 parent = $("#item_" + menu_id).parent()
                 $("#item_" + menu_id).remove();
+                delete TICKETS[menu_id]
             } else alert('Unknown response')
         },
         statusCode: {
@@ -101,6 +116,8 @@ function get_new_orders() {
     obj = {
         restaurant_id: rest_id
     }
+    // only what changed since the last response
+    if (CURSOR !== null) obj.since = CURSOR
     $.ajax({
         type: "POST",
         url: BASE_URL + "/new_orders",
@@ -108,49 +125,7 @@ function get_new_orders() {
         dataType: "json",
         contentType: "application/json",
         headers: { "X-Auth-Token": jwt_token },
-        success: function(response) {
-            if (response.hasOwnProperty("error")) {
-                alert(response.error)
-            } else if (response.hasOwnProperty("new_orders")) {
-                console.log(response)
-                tables = response["new_orders"]
-
-                $('.new_order_cards').remove()
-                var count = 0
-                for (let key in tables) {
-                    if (tables.hasOwnProperty(key)) {
-                        count++
-                        table = key
-                        var val = tables[key];
-                        var username = val["users.name"];
-                        var orders = val["orders"];
-                        $('#card_container').append(`
-                    <div class="xl:w-1/3 md:w-1/2 p-4 new_order_cards">
-                        <div class="bg-gray-100 p-6 rounded-lg shadow-md border-2">
-                            <h2 class="text-lg text-gray-600 font-medium title-font mb-4 pr-16 lg:pr-0">${table}</h2>
-                            <p class="text-xs mt-2">Cust Name:<span class="ml-2 text-purple-600">${username}</span></p>
-                            <div id="${table.replace(/\s/g, "")}_menu_div" class="">                                
-                            </div>
-                        </div>
-                    </div>
-                    `)
-                        orders.forEach(element => {
-                            $(`#${table.replace(/\s/g, "")}_menu_div`).append(`
-                       <div id="item_${element["id"]}" class="border-2 border-indigo-200 rounded-xl shadow-sm h-auto flex my-3">
-                       <p class="p-3 w-5/6">${element["name"]}</p>
-                       <input id="${element["id"]}" onclick="newItemChecked(this)" type="checkbox" class="mt-4 mr-5">
-                       <p class="bg-blue-500 rounded-r-xl text-white p-3">${element["quantity"]}</p>
-                       </div>
-                       `)
-                        });
-
-                        console.log("new orders clicked:" + NEW_ORDERS_CLICKED)
-                        if (!NEW_ORDERS_CLICKED) $('.new_order_cards').hide()
-                    }
-                }
-                $('#order-count').html(count)
-            } else alert('Unknown response')
-        },
+        success: update_new_orders,
         statusCode: {
             401: function(xhr) {
                 var obj = JSON.parse(xhr.responseText)
@@ -163,6 +138,128 @@ function get_new_orders() {
     });
 }
 
+// Applies a whole board, or the changes since CURSOR when the response has
+// "delivered", to TICKETS and renders it
+function update_new_orders(response) {
+    if (!response.hasOwnProperty("cursor")) return render_new_orders(response)
+
+    if (response.hasOwnProperty("delivered")) {
+        response["delivered"].forEach(id => delete TICKETS[id])
+    } else TICKETS = {}
+
+    var tables = response["new_orders"]
+    for (let key in tables) {
+        if (tables.hasOwnProperty(key)) tables[key]["orders"].forEach(ticket => TICKETS[ticket["id"]] = ticket)
+    }
+    CURSOR = response["cursor"]
+
+    var board = {}
+    for (let id in TICKETS) {
+        var ticket = TICKETS[id]
+        var table = board[ticket["tables.name"]] || { orders: [] }
+        table["orders"].push(ticket)
+        table["users.name"] = ticket["users.name"]
+        board[ticket["tables.name"]] = table
+    }
+    render_new_orders({ new_orders: board })
+}
+
+function render_new_orders(response) {
+    if (response.hasOwnProperty("error")) {
+        alert(response.error)
+    } else if (response.hasOwnProperty("new_orders")) {
+        console.log(response)
+        tables = response["new_orders"]
+
+        $('.new_order_cards').remove()
+        var count = 0
+        for (let key in tables) {
+            if (tables.hasOwnProperty(key)) {
+                count++
+                table = key
+                var val = tables[key];
+                var username = val["users.name"];
+                var orders = val["orders"];
+                $('#card_container').append(`
+            <div class="xl:w-1/3 md:w-1/2 p-4 new_order_cards">
+                <div class="bg-gray-100 p-6 rounded-lg shadow-md border-2">
+                    <h2 class="text-lg text-gray-600 font-medium title-font mb-4 pr-16 lg:pr-0">${table}</h2>
+                    <p class="text-xs mt-2">Cust Name:<span class="ml-2 text-purple-600">${username}</span></p>
+                    <div id="${table.replace(/\s/g, "")}_menu_div" class="">                                
+                    </div>
+                </div>
+            </div>
+            `)
+                orders.forEach(element => {
+                    $(`#${table.replace(/\s/g, "")}_menu_div`).append(`
+               <div id="item_${element["id"]}" class="border-2 border-indigo-200 rounded-xl shadow-sm h-auto flex my-3">
+               <p class="p-3 w-5/6">${element["name"]}</p>
+               <input id="${element["id"]}" onclick="newItemChecked(this)" type="checkbox" class="mt-4 mr-5">
+               <p class="bg-blue-500 rounded-r-xl text-white p-3">${element["quantity"]}</p>
+               </div>
+               `)
+                });
+
+                console.log("new orders clicked:" + NEW_ORDERS_CLICKED)
+                if (!NEW_ORDERS_CLICKED) $('.new_order_cards').hide()
+            }
+        }
+        $('#order-count').html(count)
+    } else alert('Unknown response')
+}
+
+function start_polling() {
+    get_new_orders()
+    setInterval(function() {
+        get_new_orders()
+    }, 5000);
+}
+
+// The server pushes the board whenever an item is ordered or delivered.
+// Falls back to polling when the browser has no EventSource or the server
+// refuses the stream.
+function start_kitchen_stream() {
+    if (!window.EventSource) return false
+
+    jwt_token = getCookie("jwt_token")
+    rest_id = getCookie("rest_id")
+
+    // the stream url carries a short lived ticket rather than the jwt
+    $.ajax({
+        type: "POST",
+        url: BASE_URL + "/kitchen_stream_ticket",
+        data: JSON.stringify({ restaurant_id: rest_id }),
+        dataType: "json",
+        contentType: "application/json",
+        headers: { "X-Auth-Token": jwt_token },
+        success: function(response) {
+            if (response.hasOwnProperty("ticket")) open_kitchen_stream(response["ticket"])
+            else start_polling()
+        },
+        error: function() {
+            start_polling()
+        }
+    })
+    return true
+}
+
+function open_kitchen_stream(ticket) {
+    var received = false
+    var source = new EventSource(BASE_URL + "/kitchen_stream?ticket=" + encodeURIComponent(ticket))
+
+    source.addEventListener("board", function(e) {
+        received = true
+        update_new_orders(JSON.parse(e.data))
+    })
+    source.onerror = function() {
+        // the ticket has expired by the time the stream ends, reconnect with
+        // a new one. A stream that never sent the board was refused
+        source.close()
+        if (received) start_kitchen_stream()
+        else start_polling()
+    }
+}
+
 function get_served_orders() {
     $('#loading_icon').fadeIn(200)
 
@@ -249,10 +346,7 @@ $(document).ready(function() {
     check_if_jwt_exists()
 
     $('#loading_icon').fadeIn(200)
-    get_new_orders()
+    if (!start_kitchen_stream()) start_polling()
     $('#loading_icon').fadeOut(200)
-    setInterval(function() {
-        get_new_orders()
-    }, 5000);
 
 });
\ No newline at end of file
@@ -0,0 +1,27 @@
+"""
+Conditional GET support. Endpoints whose response is fully determined by
+something cached call not_modified() before building the response, so a
+client or proxy that already has it gets a 304 without any work being done.
+"""
+from flask import make_response, request
+
+from config import http_cache_max_age
+
+
+def _cache_headers(response, etag):
+    response.set_etag(etag)
+    # public so that a CDN or reverse proxy in front of us can answer
+    # repeat requests, must-revalidate so it asks us once max-age is over
+    response.headers['Cache-Control'] = f'public, max-age={http_cache_max_age}, must-revalidate'
+    return response
+
+
+def not_modified(etag):
+    """Returns a 304 response if the request already has `etag`, else None"""
+    if etag in request.if_none_match:
+        return _cache_headers(make_response('', 304), etag)
+    return None
+
+
+def cacheable(body, etag):
+    return _cache_headers(make_response(body), etag)
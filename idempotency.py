@@ -0,0 +1,87 @@
+"""
+Idempotency-Key support for the endpoints clients retry on a bad connection.
+
+The key is stored with the response in the same transaction as the writes
+it belongs to, so a retry either finds the request fully done or not done at
+all. Checking costs nothing on the first attempt: the key is only inserted
+right before the commit, and the primary key tells us if it was already
+there. The process that answered also keeps the response in memory, so most
+retries are replayed without touching the database.
+"""
+import json
+import logging
+
+import pymysql
+
+import config
+import metrics
+from cache import TTLCache
+from db_utils import connection
+
+logger = logging.getLogger(__name__)
+
+MaxKeyLength = 64
+
+_responses = TTLCache('idempotency_cache', config.idempotency_cache_size, config.idempotency_key_ttl)
+
+
+def valid_key(key):
+    return 0 < len(key) <= MaxKeyLength
+
+
+def replay(user_id, endpoint, key):
+    """
+    The response already sent for this key by this process, or None.
+    Keys are per user so nobody can read another user's response.
+    """
+    if key is None:
+        return None
+
+    response = _responses.get((user_id, endpoint, key))
+    if response is not None:
+        metrics.incr('idempotency.replayed')
+    return response
+
+
+def commit(conn, user_id, endpoint, key, response):
+    """
+    Commits the transaction on `conn` together with the key and returns the
+    response to send. When another request with the same key already
+    committed, the transaction is rolled back instead and the response of
+    that request is returned.
+    """
+    if key is None:
+        conn.commit()
+        return response
+
+    with conn.cursor() as cur:
+        try:
+            cur.execute(
+                'insert into idempotency_keys(user_id, endpoint, idempotency_key, response) '
+                'values (%s, %s, %s, %s)',
+                (user_id, endpoint, key, json.dumps(response))
+            )
+        except pymysql.err.IntegrityError:
+            conn.rollback()
+            cur.execute(
+                'select response from idempotency_keys '
+                'where user_id = %s and endpoint = %s and idempotency_key = %s',
+                (user_id, endpoint, key)
+            )
+            response = json.loads(cur.fetchone()[0])
+            metrics.incr('idempotency.replayed')
+        else:
+            conn.commit()
+
+    _responses.set((user_id, endpoint, key), response)
+    return response
+
+
+def purge_expired():
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            'delete from idempotency_keys '
+            f'where created_at < DATE_SUB(NOW(), INTERVAL {int(config.idempotency_key_ttl)} SECOND)'
+        )
+        conn.commit()
+        logger.info('deleted %d expired idempotency keys', cur.rowcount)
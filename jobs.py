@@ -0,0 +1,40 @@
+"""
+Periodic jobs run in the background of every server process.
+
+They have to be safe to run in several processes at once since each
+gunicorn worker starts its own scheduler. To run them in one process of
+their own instead, set BACKGROUND_JOBS=0 for the web processes and start
+`python jobs.py`.
+"""
+import logging
+import time
+
+from apscheduler.schedulers.background import BackgroundScheduler
+
+import config
+import idempotency
+import kitchen
+import reconciler
+
+scheduler = BackgroundScheduler(daemon=True)
+
+
+def start():
+    if not config.background_jobs or scheduler.running:
+        return
+
+    scheduler.add_job(idempotency.purge_expired, 'interval', hours=1, id='purge_idempotency_keys')
+    scheduler.add_job(kitchen.prune, 'interval', hours=1, id='prune_active_tickets')
+    if config.reconcile_payments:
+        # a run that is still going when the next is due makes that one skip
+        scheduler.add_job(reconciler.reconcile, 'interval', seconds=config.reconcile_interval,
+                          id='reconcile_payments', max_instances=1, coalesce=True)
+    scheduler.start()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s %(name)s %(asctime)s %(message)s')
+    config.background_jobs = True
+    start()
+    while True:
+        time.sleep(3600)
@@ -0,0 +1,38 @@
+import time
+
+import jwt
+
+import config
+from cache import TTLCache
+
+# the kitchen tablets poll with the same token every few seconds. Verifying
+# the signature every time is wasted work once we know the token is good
+_verified = TTLCache('jwt_cache', config.jwt_cache_size, config.jwt_cache_ttl)
+
+
+def decode(token):
+    """
+    Same as jwt.decode(token, jwt_secret, algorithms=['HS256']) but remembers
+    tokens it has already verified. Raises the same exceptions as jwt.decode.
+
+    The secret is part of the cache key so once the secret is rotated, tokens
+    verified with the old one are verified again (and rejected).
+    """
+    secret = config.jwt_secret
+    key = (secret, token)
+
+    claims = _verified.get(key)
+    if claims is not None:
+        return claims
+
+    claims = jwt.decode(token, secret, algorithms=['HS256'])
+
+    ttl = _verified.ttl
+    if 'exp' in claims:
+        # never keep a token around longer than it is valid
+        ttl = min(ttl, claims['exp'] - time.time())
+
+    if ttl > 0:
+        _verified.set(key, claims, ttl)
+
+    return claims
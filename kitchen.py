@@ -0,0 +1,395 @@
+"""
+The kitchen board of a restaurant - the items ordered but not delivered yet -
+and the kitchen_stream that pushes it to the kitchen tablets when it changes.
+
+Tickets are added with add_tickets() and delivered with deliver(). Both
+increment the restaurant's row in kitchen_versions and stamp the tickets
+they touch with the new version, which is the cursor new_orders takes to
+return only what changed. The writer publishes ItemsAdded or ItemDelivered
+after the commit, and the kitchen's subscriber calls notify().
+
+One watcher thread per process reads the versions of the restaurants that
+have a stream open in one query every `kitchen_poll_interval` seconds, or
+right away after a notify() from this process, and wakes the streams of the
+restaurants whose version changed. The board itself is loaded once per
+version, however many tablets watch it.
+"""
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+from uuid import uuid4
+
+import pymysql
+
+import config
+import events
+import metrics
+import paytm
+from cache import TTLCache, SingleFlight
+from db_utils import connection
+
+logger = logging.getLogger(__name__)
+
+# the columns of active_tickets under the names the board always had
+BoardColumns = (
+    "id, menu_name as name, description, quantity, table_id, "
+    "user_name as `users.name`, table_name as `tables.name`, order_id as `orders.id` "
+)
+
+# delivered tickets stay in active_tickets while recent_orders shows them
+RecentCutoff = "DATE_SUB(CURDATE(), INTERVAL 1 DAY)"
+
+# the board, the changes since a cursor and admin recent_orders.
+# explain_report explains these queries
+BoardQuery = (
+    "select " + BoardColumns +
+    "from active_tickets "
+    "where restaurant_id = %(restaurant_id)s and delivered_items = 1 "
+    "order by ordered_at"
+)
+ChangesQuery = (
+    "select " + BoardColumns + ", delivered_items "
+    "from active_tickets "
+    "where restaurant_id = %(restaurant_id)s and seq > %(since)s and seq <= %(cursor)s "
+    "order by seq"
+)
+RecentOrdersQuery = (
+    "select user_name as name, quantity, menu_name as `menu.name`, payment_status, "
+    "ordered_at as time_and_date, table_name as `tables.name`, order_id as id "
+    "from active_tickets "
+    "where restaurant_id = %(restaurant_id)s and delivered_items = 0 and payment_status != %(paid)s "
+    "and ordered_at > " + RecentCutoff + " "
+    "order by ordered_at"
+)
+
+
+def _versions_row(cur, restaurant_id):
+    """(version, pruned_seq) of the restaurant"""
+    cur.execute('select version, pruned_seq from kitchen_versions where restaurant_id = %s', (restaurant_id,))
+    row = cur.fetchone()
+    if not row:
+        return 0, 0
+    return (row['version'], row['pruned_seq']) if isinstance(row, dict) else tuple(row)
+
+
+def _by_table(tickets):
+    table_wise_orders = {}
+
+    for order in tickets:
+        order["quantity"] = str(order["quantity"])
+        orders_by_table = table_wise_orders.get(order['tables.name'], {})
+        orders = orders_by_table.get('orders', [])
+        orders.append(order)
+        orders_by_table['orders'] = orders
+        orders_by_table['users.name'] = order['users.name']
+        table_wise_orders[order['tables.name']] = orders_by_table
+
+    return table_wise_orders
+
+
+def load_board(conn, restaurant_id):
+    """The /admin/new_orders response of the restaurant, with the cursor it is current to"""
+    with conn.cursor(pymysql.cursors.DictCursor) as cur:
+        # read in one transaction, so the board is exactly what the cursor has seen
+        cursor, _ = _versions_row(cur, restaurant_id)
+        cur.execute(BoardQuery, {'restaurant_id': restaurant_id})
+        yet_to_deliver = cur.fetchall()
+
+    return {"cursor": cursor, "new_orders": _by_table(yet_to_deliver)}
+
+
+def load_changes(conn, restaurant_id, since):
+    """
+    The tickets of the restaurant added or delivered after the `since`
+    cursor. Returns None when the changes are not known any more - `since`
+    is from before tickets that were pruned, or ahead of the restaurant
+    after a database restore - and the whole board has to be loaded.
+    """
+    with conn.cursor(pymysql.cursors.DictCursor) as cur:
+        cursor, pruned_seq = _versions_row(cur, restaurant_id)
+        if since > cursor or since < pruned_seq:
+            return None
+
+        # tickets of later transactions may be committing already, stop at the
+        # cursor so the next request returns them
+        cur.execute(ChangesQuery, {'restaurant_id': restaurant_id, 'since': since, 'cursor': cursor})
+        changed = cur.fetchall()
+
+    added, delivered = [], []
+    for ticket in changed:
+        if ticket.pop('delivered_items') == 1:
+            added.append(ticket)
+        else:
+            delivered.append(ticket['id'])
+
+    return {"cursor": cursor, "new_orders": _by_table(added), "delivered": delivered}
+
+
+def bump(cur, restaurant_id):
+    """
+    Marks the board of the restaurant changed and returns its new version.
+    Call in the transaction that changes it.
+    """
+    cur.execute(
+        'insert into kitchen_versions(restaurant_id, version) values (%s, 1) '
+        'on duplicate key update version = version + 1',
+        (restaurant_id,)
+    )
+    return _versions_row(cur, restaurant_id)[0]
+
+
+def add_tickets(cur, restaurant_id, all_orders):
+    """
+    Adds a kitchen ticket for every item of the basket, which is all of one
+    order. Returns False when an item is not on the restaurant's menu or is
+    disabled - the caller's cached menu was stale - and the transaction has
+    to be rolled back.
+    """
+    order_id = all_orders[0].order_id
+    seq = bump(cur, restaurant_id)
+    created_at = datetime.utcnow()
+    cur.executemany(
+        "insert into new_orders(id, order_id, menu_id, quantity, restaurant_id, seq, created_at) "
+        "values (%s,%s,%s,%s,%s,%s,%s)",
+        [(str(uuid4()), order.order_id, order.menu_id, order.quantity, restaurant_id, seq, created_at)
+         for order in all_orders]
+    )
+    # the joins only look up the one order, table and user and the basket's
+    # menu items by their primary keys. Joining only orderable items makes
+    # this the check of the basket against the menu, at no extra round trip
+    cur.execute(
+        "insert into active_tickets(id, restaurant_id, order_id, table_id, table_name, user_name, menu_name, "
+        "description, quantity, payment_status, delivered_items, seq, ordered_at) "
+        "select new_orders.id, orders.restaurant_id, orders.id, orders.table_id, tables.name, users.name, "
+        "menu.name, menu.description, new_orders.quantity, orders.payment_status, 1, new_orders.seq, "
+        "orders.time_and_date "
+        "from new_orders "
+        "join menu on new_orders.menu_id = menu.id "
+        "join orders on orders.id = new_orders.order_id "
+        "join tables on tables.id = orders.table_id "
+        "join users on orders.user_id = users.id "
+        "where new_orders.order_id = %s and new_orders.seq = %s "
+        "and menu.restaurant_id = orders.restaurant_id and menu.active_menu = 0",
+        (order_id, seq)
+    )
+    return cur.rowcount == len(all_orders)
+
+
+def deliver(cur, restaurant_id, ticket_id):
+    """
+    Marks a ticket of the restaurant delivered. Returns False, changing
+    nothing, for tickets of other restaurants and ones already delivered.
+    """
+    cur.execute(
+        "update new_orders set delivered_items = 0 "
+        "where id = %s and restaurant_id = %s and delivered_items = 1",
+        (ticket_id, restaurant_id)
+    )
+    if cur.rowcount == 0:
+        return False
+
+    # only now, a ticket that was not delivered here must not move the
+    # cursor and send every client of the board an empty change
+    seq = bump(cur, restaurant_id)
+    cur.execute("update new_orders set seq = %s where id = %s", (seq, ticket_id))
+    cur.execute(
+        "update active_tickets set delivered_items = 0, seq = %s where id = %s",
+        (seq, ticket_id)
+    )
+    return True
+
+
+def table_renamed(cur, restaurant_id, table_id, name):
+    """
+    Shows the table's tickets under its new name. The tickets still on the
+    board get a new seq, so that clients with a cursor receive them again
+    """
+    seq = bump(cur, restaurant_id)
+    cur.execute(
+        'update active_tickets set table_name = %s, '
+        'seq = case when delivered_items = 1 then %s else seq end '
+        'where table_id = %s',
+        (name, seq, table_id)
+    )
+
+
+def payment_changed(cur, order_ids, payment_status):
+    """Copies the new payment status of the orders to their tickets"""
+    cur.execute(
+        'update active_tickets set payment_status = %s '
+        'where order_id in %s and payment_status <> %s',
+        (payment_status.value, tuple(order_ids), paytm.PaymentStatus.SUCCESSFUL.value)
+    )
+
+
+def prune():
+    """
+    Deletes the delivered tickets that recent_orders does not show any more.
+    The restaurants remember the highest seq deleted, so that clients with an
+    older cursor reload the board instead of missing the deletions.
+    """
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            'update kitchen_versions set pruned_seq = greatest(pruned_seq, ('
+            'select max(seq) from active_tickets '
+            'where active_tickets.restaurant_id = kitchen_versions.restaurant_id '
+            f'and delivered_items = 0 and ordered_at < {RecentCutoff})) '
+            'where restaurant_id in ('
+            f'select restaurant_id from active_tickets where delivered_items = 0 and ordered_at < {RecentCutoff})'
+        )
+        # a ticket delivered since the update above keeps its row until the next run
+        cur.execute(
+            f'delete from active_tickets where delivered_items = 0 and ordered_at < {RecentCutoff} '
+            'and seq <= (select pruned_seq from kitchen_versions '
+            'where kitchen_versions.restaurant_id = active_tickets.restaurant_id)'
+        )
+        conn.commit()
+        logger.info('pruned %d delivered kitchen tickets', cur.rowcount)
+
+
+def notify(restaurant_id):
+    """Call after committing a bump() so that streams in this process don't wait for the next poll"""
+    if restaurant_id in _versions:
+        _poll_now.set()
+
+
+# restaurant id -> last version read, for every restaurant with a stream open
+_versions = {}
+_subscribers = {}
+_changed = threading.Condition()
+_poll_now = threading.Event()
+_watcher = None
+
+_boards = TTLCache('kitchen_board_cache', config.kitchen_board_cache_size, config.kitchen_stream_duration)
+_board_loads = SingleFlight('kitchen_board')
+
+_streams = threading.BoundedSemaphore(config.kitchen_stream_max)
+
+
+def _read_versions(restaurant_ids):
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            'select restaurant_id, version from kitchen_versions where restaurant_id in %s',
+            (tuple(restaurant_ids),)
+        )
+        versions = dict(cur.fetchall())
+
+    return {restaurant_id: versions.get(restaurant_id, 0) for restaurant_id in restaurant_ids}
+
+
+def _watch():
+    while True:
+        _poll_now.wait(config.kitchen_poll_interval)
+        _poll_now.clear()
+
+        with _changed:
+            restaurant_ids = list(_versions)
+        if not restaurant_ids:
+            continue
+
+        try:
+            versions = _read_versions(restaurant_ids)
+        except pymysql.err.Error:
+            metrics.incr('kitchen.poll_errors')
+            time.sleep(config.kitchen_poll_interval)
+            continue
+
+        with _changed:
+            changed = False
+            for restaurant_id, version in versions.items():
+                if restaurant_id in _versions and _versions[restaurant_id] != version:
+                    _versions[restaurant_id] = version
+                    changed = True
+            if changed:
+                _changed.notify_all()
+
+
+def _subscribe(restaurant_id):
+    global _watcher
+
+    with _changed:
+        if _watcher is None:
+            _watcher = threading.Thread(target=_watch, name='kitchen-watcher', daemon=True)
+            _watcher.start()
+
+        _subscribers[restaurant_id] = _subscribers.get(restaurant_id, 0) + 1
+        if restaurant_id in _versions:
+            return _versions[restaurant_id]
+
+    version = _read_versions([restaurant_id])[restaurant_id]
+    with _changed:
+        return _versions.setdefault(restaurant_id, version)
+
+
+def _unsubscribe(restaurant_id):
+    with _changed:
+        _subscribers[restaurant_id] -= 1
+        if _subscribers[restaurant_id] == 0:
+            del _subscribers[restaurant_id]
+            _versions.pop(restaurant_id, None)
+
+
+def _board(restaurant_id, version):
+    key = (restaurant_id, version)
+    board = _boards.get(key)
+    if board is not None:
+        return board
+
+    def load():
+        with connection() as conn:
+            board = json.dumps(load_board(conn, restaurant_id), separators=(',', ':'), default=str)
+        _boards.set(key, board)
+        return board
+
+    return _board_loads.do(key, load)
+
+
+def _event(data):
+    return f'event: board\ndata: {data}\n\n'
+
+
+def stream(restaurant_id):
+    """
+    Generator of the text/event-stream for a kitchen tablet. Returns None
+    when this process already serves `kitchen_stream_max` streams.
+    """
+    if not _streams.acquire(blocking=False):
+        metrics.incr('kitchen.stream_rejected')
+        return None
+
+    def events():
+        try:
+            version = _subscribe(restaurant_id)
+            # tell the browser to reconnect after 1s instead of its default 3s
+            yield 'retry: 1000\n' + _event(_board(restaurant_id, version))
+
+            # streams end every now and then, the browser reconnects on its own
+            deadline = time.monotonic() + config.kitchen_stream_duration
+            while time.monotonic() < deadline:
+                with _changed:
+                    _changed.wait_for(lambda: _versions[restaurant_id] != version,
+                                      config.kitchen_stream_heartbeat)
+                    new_version = _versions[restaurant_id]
+
+                if new_version == version:
+                    # keeps proxies from closing an idle connection
+                    yield ': keep alive\n\n'
+                    continue
+
+                version = new_version
+                metrics.incr('kitchen.pushed')
+                yield _event(_board(restaurant_id, version))
+        finally:
+            _unsubscribe(restaurant_id)
+            _streams.release()
+
+    return events()
+
+
+def _on_event(event):
+    notify(event.restaurant_id)
+
+
+events.subscribe('kitchen', _on_event, events.ItemsAdded, events.ItemDelivered, events.TableRenamed)
@@ -0,0 +1,133 @@
+"""
+Per restaurant cache of the menu.
+
+Menus only change through the admin new_menu and delete_menu endpoints,
+which call invalidate(). Other server processes keep their copy until it
+expires, so writing an order's kitchen tickets checks the items against
+the menu table again, and a stale basket is rolled back.
+
+When an entry is missing, one request loads it and every other request for
+the same restaurant waits for that instead of querying too.
+"""
+import gzip
+import hashlib
+import json
+import threading
+from collections import namedtuple
+
+import config
+import restaurant_cache
+from cache import TTLCache, SingleFlight
+from db_utils import connection
+
+MenuItem = namedtuple('MenuItem', ['id', 'name', 'description', 'photo_url', 'price', 'active'])
+
+# `items` maps menu id to MenuItem for every item of the restaurant,
+# including disabled ones so that ordering them gives a useful error.
+# `etag` is a hash of everything above, it changes whenever the menu does.
+# `payload` and `gzipped` are the /menu response already encoded when
+# MENU_PRESERIALIZED (and MENU_PREGZIP) are on, otherwise None
+Menu = namedtuple('Menu', ['restaurant_id', 'restaurant', 'items', 'etag', 'payload', 'gzipped'])
+
+_menus = TTLCache('menu_cache', config.menu_cache_size, config.menu_cache_ttl)
+_loads = SingleFlight('menu_cache.load')
+
+# bumped by invalidate() so that a load which started before a menu change
+# does not put the old menu back in the cache
+_generations = {}
+_generations_lock = threading.Lock()
+
+
+# every item, disabled ones included. explain_report explains this query
+MenuQuery = (
+    'select id, name, description, photo_url, price, active_menu '
+    'from menu '
+    'where restaurant_id = %(restaurant_id)s'
+)
+
+
+def _load(conn, restaurant_id):
+    restaurant = restaurant_cache.get(conn, restaurant_id)
+    if restaurant is None:
+        return None
+
+    with conn.cursor() as cur:
+        cur.execute(MenuQuery, {'restaurant_id': restaurant_id})
+
+        items = {}
+        for id, name, description, photo_url, price, active_menu in cur.fetchall():
+            # active_menu is 0 for items that can be ordered and 1 for deleted ones
+            items[id] = MenuItem(id, name, description, photo_url, price, active_menu == 0)
+
+    # derived from the content rather than a counter so that every server
+    # process that has the same menu hands out the same etag
+    etag = hashlib.sha1(repr((restaurant.name, list(items.values()))).encode('utf-8')).hexdigest()
+
+    menu = Menu(restaurant_id, restaurant.name, items, etag, None, None)
+
+    if config.menu_preserialized:
+        # encoded the way flask's jsonify encodes it, once per menu change
+        # instead of on every request
+        payload = (json.dumps(response_body(menu), separators=(',', ':'), sort_keys=True) + '\n').encode('utf-8')
+        gzipped = gzip.compress(payload) if config.menu_pregzip else None
+        menu = menu._replace(payload=payload, gzipped=gzipped)
+
+    return menu
+
+
+def response_body(menu):
+    """The /menu response for the menu, as a dict"""
+    items = []
+
+    for item in menu.items.values():
+        if not item.active:
+            continue
+
+        items.append(
+            {
+                'id': item.id,
+                'name': item.name,
+                'description': item.description,
+                'photo_url': item.photo_url,
+                # price is stored as decimal during conversion
+                # which cannot be converted to json by default.
+                # So I am converting it to float which can be
+                # used in json
+                'price': float(item.price),
+            }
+        )
+
+    return {'menu': items, 'restaurant': menu.restaurant}
+
+
+def _load_and_store(restaurant_id):
+    generation = _generations.get(restaurant_id, 0)
+
+    # always the primary. A replica that is behind would put a menu
+    # in the cache without the item the admin just added
+    with connection() as conn:
+        menu = _load(conn, restaurant_id)
+
+    if menu is not None and _generations.get(restaurant_id, 0) == generation:
+        _menus.set(restaurant_id, menu)
+    return menu
+
+
+def get(restaurant_id):
+    """
+    Returns the Menu of the restaurant or None if the restaurant does not
+    exist. A connection is opened only on a cache miss, so don't call this
+    while holding one: requests waiting for the load would hold connections
+    the request loading it may need.
+    """
+    menu = _menus.get(restaurant_id)
+    if menu is not None:
+        return menu
+
+    return _loads.do(restaurant_id, lambda: _load_and_store(restaurant_id))
+
+
+def invalidate(restaurant_id):
+    with _generations_lock:
+        _generations[restaurant_id] = _generations.get(restaurant_id, 0) + 1
+    _menus.pop(restaurant_id)
@@ -0,0 +1,69 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from flask import g, has_request_context, request
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+
+
+def incr(name, amount=1):
+    """Adds `amount` to a process wide counter"""
+    with _lock:
+        _counters[name] += amount
+
+
+def gauge(name, value):
+    """Sets a process wide value that is replaced rather than added to"""
+    with _lock:
+        _counters[name] = value
+
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+def observe(name, seconds):
+    """
+    Records that something called `name` took `seconds`.
+
+    It is added to the process wide counters as `<name>.count` and
+    `<name>.seconds` and, when called while handling a request, to that
+    request's Server-Timing header.
+    """
+    with _lock:
+        _counters[name + '.count'] += 1
+        _counters[name + '.seconds'] += seconds
+
+    if has_request_context():
+        timings = g.setdefault('timings', defaultdict(lambda: [0, 0.0]))
+        timings[name][0] += 1
+        timings[name][1] += seconds
+
+
+def _before_request():
+    g.request_started = time.perf_counter()
+
+
+def _after_request(response):
+    timings = g.get('timings', {})
+    elapsed = time.perf_counter() - g.get('request_started', time.perf_counter())
+
+    # Server-Timing shows up in the browser dev tools next to the request
+    server_timing = [f'total;dur={elapsed * 1000:.1f}']
+    for name, (count, seconds) in timings.items():
+        server_timing.append(f'{name};dur={seconds * 1000:.1f};desc="{count}"')
+    response.headers['Server-Timing'] = ', '.join(server_timing)
+
+    observe('request.' + str(request.endpoint), elapsed)
+    return response
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
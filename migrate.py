@@ -0,0 +1,122 @@
+"""
+Applies the sql files in migrations/ in order and remembers which ones ran.
+
+usage -
+    python migrate.py                   apply all pending migrations
+    python migrate.py status            list migrations and whether they ran
+    python migrate.py baseline <version>
+                                        mark everything up to <version> as applied
+                                        without running it
+
+Migration files are named <version>_<description>.sql, for example
+0002_hot_path_indexes.sql. Never edit a migration once it has been deployed,
+add a new one instead.
+"""
+import os
+import re
+import sys
+
+from db_utils import connection
+
+MigrationsDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+
+def migrations():
+    """Returns a sorted list of (version, name, path) for every migration file"""
+    result = []
+    for filename in os.listdir(MigrationsDirectory):
+        match = re.fullmatch(r'(\d+)_(.+)\.sql', filename)
+        if match:
+            result.append((match.group(1), match.group(2), os.path.join(MigrationsDirectory, filename)))
+
+    return sorted(result)
+
+
+def statements(sql):
+    """Splits a migration into statements. Comments are dropped"""
+    sql = re.sub(r'--[^\n]*', '', sql)
+    return [statement.strip() for statement in sql.split(';') if statement.strip()]
+
+
+def _ensure_migrations_table(cur):
+    cur.execute(
+        'create table if not exists schema_migrations('
+        'version varchar(14) primary key, '
+        'name text not null, '
+        'applied_at timestamp not null default current_timestamp)'
+    )
+
+
+def applied_versions(conn):
+    with conn.cursor() as cur:
+        _ensure_migrations_table(cur)
+        conn.commit()
+        cur.execute('select version from schema_migrations')
+        return set(map(lambda row: row[0], cur.fetchall()))
+
+
+def apply_pending(conn):
+    """Applies every migration that has not run yet on `conn`"""
+    applied = applied_versions(conn)
+    pending = [m for m in migrations() if m[0] not in applied]
+
+    if not pending:
+        print('database is up to date')
+        return
+
+    for version, name, path in pending:
+        print(f'applying {version} {name}')
+        with open(path) as f:
+            sql = f.read()
+
+        # mysql commits ddl statements implicitly so a migration that fails
+        # halfway cannot be rolled back. It is only recorded once every
+        # statement in it succeeded, whatever did run before the failure
+        # has to be undone by hand before running it again
+        with conn.cursor() as cur:
+            for statement in statements(sql):
+                cur.execute(statement)
+
+            cur.execute(
+                'insert into schema_migrations(version, name) values (%s, %s)',
+                (version, name)
+            )
+            conn.commit()
+
+
+def migrate():
+    with connection() as conn:
+        apply_pending(conn)
+
+
+def status():
+    with connection() as conn:
+        applied = applied_versions(conn)
+
+    for version, name, _ in migrations():
+        print(f'{version} {name}: {"applied" if version in applied else "pending"}')
+
+
+def baseline(up_to_version):
+    with connection() as conn:
+        applied = applied_versions(conn)
+        with conn.cursor() as cur:
+            for version, name, _ in migrations():
+                if version <= up_to_version and version not in applied:
+                    cur.execute(
+                        'insert into schema_migrations(version, name) values (%s, %s)',
+                        (version, name)
+                    )
+            conn.commit()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        migrate()
+    elif sys.argv[1] == 'status':
+        status()
+    elif sys.argv[1] == 'baseline' and len(sys.argv) == 3:
+        baseline(sys.argv[2])
+    else:
+        print(__doc__)
+        sys.exit(1)
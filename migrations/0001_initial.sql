@@ -1,4 +1,7 @@
-create table users
+-- schema as it was in init.sql. "if not exists" lets databases created
+-- from init.sql adopt the migrations without any manual step
+
+create table if not exists users
 (
     id            varchar(36) primary key,
     name          text         not null,
@@ -8,7 +11,7 @@ create table users
 
 
 
-create table restaurant
+create table if not exists restaurant
 (
     id          varchar(36) primary key,
     name        text          not null,
@@ -22,7 +25,7 @@ create table restaurant
 -- will add more things like co ordinates when we get to browse
 -- lets focus on core features first
 
-create table menu
+create table if not exists menu
 (
     id            serial primary key,
     name          text          not null,
@@ -36,7 +39,7 @@ create table menu
 --default 0 is True by default.
 
 
-create table orders
+create table if not exists orders
 (
     id                  varchar(36) primary key,
     user_id             varchar(36) not null references users (id),
@@ -49,7 +52,7 @@ create table orders
 );
 
 
-create table order_items
+create table if not exists order_items
 (
     order_id varchar(36)   not null references orders (id),
     menu_id  int           not null references menu (id),
@@ -58,14 +61,14 @@ create table order_items
     primary key (order_id, menu_id)
 );
 
-create table tables
+create table if not exists tables
 (
     id            serial primary key,
     name          text        not null,
     restaurant_id varchar(36) not null references restaurant (id)
 );
 
-create table transactions
+create table if not exists transactions
 (
     id             varchar(36) primary key,
     order_id       varchar(36)   not null references orders (id),
@@ -73,7 +76,7 @@ create table transactions
     payment_status int           not null
 );
 
-create table admin
+create table if not exists admin
 (
     id             varchar(36) primary key,
     f_name         varchar(60)         not null,
@@ -83,8 +86,11 @@ create table admin
     password       varchar(100)        not null
 );
 
-create table new_orders(
+create table if not exists new_orders(
     id varchar(36) primary key,
     order_id varchar(36) not null,
     menu_id varchar(36) not null,
-    quantity int(2) not null);
\ No newline at end of file
+    quantity int(2) not null,
+    delivered_items tinyint not null default 1);
+
+-- delivered_items is 1 until the kitchen marks the item delivered, then 0
@@ -0,0 +1,33 @@
+-- indexes for the queries that run on every page load. Column order follows
+-- the where clause first (equality, then range) and then the order by, so
+-- mysql can read rows already sorted instead of filesorting them
+
+-- user order_history: where user_id = ? order by time_and_date desc
+create index orders_user_time on orders (user_id, time_and_date);
+
+-- admin order_history: where restaurant_id = ? and payment_status = 0 order by time_and_date desc
+create index orders_restaurant_status_time on orders (restaurant_id, payment_status, time_and_date);
+
+-- recent_orders and new_orders: where restaurant_id = ? [and time_and_date > ?] order by time_and_date
+create index orders_restaurant_time on orders (restaurant_id, time_and_date);
+
+-- delete_table: where table_id = ?
+create index orders_table on orders (table_id);
+
+-- new_orders and recent_orders join new_orders on order_id and filter on delivered_items
+create index new_orders_order_delivered on new_orders (order_id, delivered_items);
+
+-- get_menu: where restaurant_id = ? and active_menu = 0
+create index menu_restaurant_active on menu (restaurant_id, active_menu);
+
+-- delete_menu: order_items joined on menu_id. order_id is already covered by the primary key
+create index order_items_menu on order_items (menu_id);
+
+-- checkout and payment status lookups by order
+create index transactions_order on transactions (order_id);
+
+-- get_restaurant_ids and every ownership check by admin
+create index restaurant_admin on restaurant (admin_id);
+
+-- all_tables: where restaurant_id = ?
+create index tables_restaurant on tables (restaurant_id);
@@ -0,0 +1,14 @@
+-- responses of requests sent with an Idempotency-Key header, so that a
+-- retried /order or /order_items is answered without writing again.
+-- Rows older than IDEMPOTENCY_KEY_TTL are deleted by jobs.py
+create table if not exists idempotency_keys
+(
+    user_id         varchar(36) not null,
+    endpoint        varchar(32) not null,
+    idempotency_key varchar(64) not null,
+    response        text        not null,
+    created_at      timestamp   not null default now(),
+    primary key (user_id, endpoint, idempotency_key)
+);
+
+create index idempotency_keys_created on idempotency_keys (created_at);
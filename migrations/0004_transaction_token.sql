@@ -0,0 +1,3 @@
+-- checkout commits the transaction row before asking paytm for a token and
+-- records the token afterwards, so it is null until then
+alter table transactions add column txn_token varchar(128) null;
@@ -0,0 +1,8 @@
+-- for the payment reconciler. Both are utc and set by the app, rows from
+-- before this migration have no created_at and count as old
+alter table transactions add column created_at timestamp null;
+
+alter table transactions add column checked_at timestamp null;
+
+-- reconciler: where payment_status in (...) and created_at < ? order by created_at
+create index transactions_status_created on transactions (payment_status, created_at);
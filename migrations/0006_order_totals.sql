@@ -0,0 +1,17 @@
+-- orders keep their running totals, updated by order_items in the same
+-- transaction as the items, so that checkout and the order histories read
+-- one row instead of adding up order_items
+alter table orders add column total numeric(7, 2) null;
+
+-- backfill. price_excluding_tax was incremented starting from null so it is
+-- null for most orders, and tax was only set at checkout
+update orders
+set price_excluding_tax = coalesce(
+    (select sum(order_items.price) from order_items where order_items.order_id = orders.id), 0);
+
+update orders
+set tax = round(price_excluding_tax *
+                (select restaurant.tax_percent from restaurant where restaurant.id = orders.restaurant_id) / 100.0, 2);
+
+update orders
+set total = price_excluding_tax + tax
@@ -0,0 +1,7 @@
+-- bumped in every transaction that adds or delivers kitchen tickets of a
+-- restaurant, kitchen_stream polls it to know when to push the board again
+create table if not exists kitchen_versions
+(
+    restaurant_id varchar(36) primary key,
+    version       bigint not null
+);
@@ -0,0 +1,16 @@
+-- kitchen tickets carry their restaurant and the restaurant's kitchen_versions
+-- version from the transaction that added or delivered them, so that
+-- new_orders can return only what changed since a cursor. The version row is
+-- locked until commit, so tickets commit in the order of their seq
+alter table new_orders add column restaurant_id varchar(36) null;
+
+alter table new_orders add column seq bigint not null default 0;
+
+-- utc and set by the app, tickets from before this migration have none
+alter table new_orders add column created_at timestamp null;
+
+update new_orders
+set restaurant_id = (select orders.restaurant_id from orders where orders.id = new_orders.order_id);
+
+-- new_orders since: where restaurant_id = ? and seq > ? and seq <= ?
+create index new_orders_restaurant_seq on new_orders (restaurant_id, seq)
@@ -0,0 +1,43 @@
+-- the kitchen tickets that the kitchen board or recent_orders can still
+-- show, with everything they display copied in so that reading them needs
+-- no join with orders, menu, tables or users. Written next to new_orders,
+-- payment_status follows the order's, and delivered tickets are pruned once
+-- recent_orders no longer shows them
+create table if not exists active_tickets
+(
+    id              varchar(36) primary key,
+    restaurant_id   varchar(36) not null,
+    order_id        varchar(36) not null,
+    table_id        int         not null,
+    table_name      text        not null,
+    user_name       text        not null,
+    menu_name       text        not null,
+    description     text        not null,
+    quantity        int         not null,
+    payment_status  int         not null,
+    delivered_items tinyint     not null default 1,
+    seq             bigint      not null,
+    ordered_at      timestamp   not null
+);
+
+-- new_orders, new_orders since and recent_orders: where restaurant_id = ? ...
+create index active_tickets_restaurant_seq on active_tickets (restaurant_id, seq);
+
+-- payment status updates: where order_id in (...)
+create index active_tickets_order on active_tickets (order_id);
+
+-- highest seq of the tickets pruned, cursors before it have to reload the board
+alter table kitchen_versions add column pruned_seq bigint not null default 0;
+
+insert into active_tickets(id, restaurant_id, order_id, table_id, table_name, user_name, menu_name, description,
+                           quantity, payment_status, delivered_items, seq, ordered_at)
+select new_orders.id, orders.restaurant_id, orders.id, orders.table_id, tables.name, users.name, menu.name,
+       menu.description, new_orders.quantity, orders.payment_status, new_orders.delivered_items, new_orders.seq,
+       orders.time_and_date
+from new_orders
+         join menu on new_orders.menu_id = menu.id
+         join orders on orders.id = new_orders.order_id
+         join tables on tables.id = orders.table_id
+         join users on orders.user_id = users.id
+where new_orders.delivered_items = 1
+   or orders.time_and_date > DATE_SUB(CURDATE(), INTERVAL 1 DAY)
@@ -0,0 +1,4 @@
+-- set by every reconciler run along with checked_at, so that a run can tell
+-- the transactions it claimed from ones another process claimed in the same
+-- second
+alter table transactions add column claimed_by varchar(36) null;
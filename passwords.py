@@ -0,0 +1,126 @@
+"""
+Password hashing, done in a pool of worker processes.
+
+bcrypt is deliberately slow. Run inline, a burst of logins at opening time
+keeps the request threads busy and every other request waits behind them.
+Here at most `bcrypt_workers` hashes run at a time, at most `bcrypt_queue_size`
+more wait for a worker, and anything beyond that fails fast with
+PasswordHasherBusy, which the app turns into a 503.
+"""
+import logging
+import multiprocessing
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+import metrics
+from config import bcrypt_workers, bcrypt_queue_size, bcrypt_rounds, bcrypt_target_seconds
+
+logger = logging.getLogger(__name__)
+
+# bcrypt's own default. Calibration never picks less on a fast machine
+MinRounds = 12
+MaxRounds = 16
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many password hashes are already running or waiting"""
+
+
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _checkpw(password, hashed_password):
+    return bcrypt.checkpw(password, hashed_password)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(bcrypt_workers + bcrypt_queue_size)
+
+rounds = bcrypt_rounds
+
+
+def calibrate():
+    """
+    Picks the highest work factor whose hash still takes less than
+    `bcrypt_target_seconds` on this machine, unless BCRYPT_ROUNDS is set.
+    """
+    global rounds
+    if bcrypt_rounds:
+        rounds = bcrypt_rounds
+        return rounds
+
+    rounds = MinRounds
+    for candidate in range(MinRounds, MaxRounds + 1):
+        started = time.perf_counter()
+        _hashpw(b'calibration', candidate)
+        elapsed = time.perf_counter() - started
+
+        if elapsed > bcrypt_target_seconds:
+            break
+        rounds = candidate
+
+        # every round doubles the time. Don't spend seconds proving that
+        # the next one is too slow
+        if elapsed * 2 > bcrypt_target_seconds:
+            break
+
+    logger.info('bcrypt work factor: %d', rounds)
+    return rounds
+
+
+def _submit(fn, *args):
+    global _executor
+
+    if not _slots.acquire(blocking=False):
+        metrics.incr('bcrypt.rejected')
+        raise PasswordHasherBusy()
+
+    try:
+        # created on first use so that every gunicorn worker gets its own.
+        # Forking from a request thread would copy locks other threads hold
+        # (logging, the connection pool) into the child, forkserver starts
+        # the workers from a clean process instead
+        with _executor_lock:
+            if _executor is None:
+                _executor = ProcessPoolExecutor(max_workers=bcrypt_workers,
+                                                mp_context=multiprocessing.get_context('forkserver'))
+            executor = _executor
+
+        started = time.perf_counter()
+        try:
+            return executor.submit(fn, *args).result()
+        except BrokenProcessPool:
+            # a worker died. Start over with a new pool next time
+            with _executor_lock:
+                if _executor is executor:
+                    _executor = None
+            raise
+        finally:
+            metrics.observe('bcrypt', time.perf_counter() - started)
+    finally:
+        _slots.release()
+
+
+def hash_password(password: str) -> str:
+    if rounds is None:
+        calibrate()
+    return _submit(_hashpw, password.encode('utf-8'), rounds).decode('utf-8')
+
+
+def password_valid(password: str, hashed_password: str) -> bool:
+    return _submit(_checkpw, password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    """True if the hash was made with a lower work factor than the current one"""
+    match = re.match(r'^\$2[abxy]?\$(\d\d)\$', hashed_password)
+    if rounds is None:
+        calibrate()
+    return match is not None and int(match.group(1)) < rounds
@@ -1,10 +1,16 @@
 import logging
+import time
 from enum import Enum
 
 from paytmpg import MerchantProperty, LibraryConstants, EChannelId, Money, EnumCurrency, UserInfo, \
     PaymentDetailsBuilder, Payment, PaymentStatusDetailBuilder
 from paytmpg.merchant.models.PaymentStatusDetail import PaymentStatusDetail
+from paytmpg.pg.constants.ErrorConstants import ErrorConstants
+from paytmpg.pg.utils.SignatureUtil import verifySignature
 
+import config
+import metrics
+from circuit_breaker import CircuitBreaker, CircuitOpen
 from config import merchant_id, merchant_key, website, callback_url
 
 
@@ -41,6 +47,9 @@ class PaymentStatus(Enum):
             return 'not_paid'
 
 
+# the states paytm can still move a transaction out of
+UnsettledStatuses = (PaymentStatus.NOT_PAID.value, PaymentStatus.PENDING.value)
+
 logger = logging.getLogger(__name__)
 
 
@@ -48,10 +57,60 @@ environment = LibraryConstants.STAGING_ENVIRONMENT
 
 MerchantProperty.initialize(environment, merchant_id, merchant_key, '1', website)
 MerchantProperty.set_callback_url(callback_url)
+MerchantProperty.set_timeout(config.paytm_connect_timeout, config.paytm_read_timeout)
+
+if config.paytm_base_url:
+    # fake_paytm.py or another stand in for paytm
+    MerchantProperty.base_url = config.paytm_base_url
+    MerchantProperty.initiate_txn_url = config.paytm_base_url + '/order/initiate'
+    MerchantProperty.payment_status_url = config.paytm_base_url + '/v3/order/status'
 
 MerchantProperty.logger = logger
 
 
+class PaytmUnavailable(Exception):
+    """
+    Raised when paytm did not answer in time or with something we could
+    read, or when it failed so often lately that it is not asked at all
+    """
+
+
+_breaker = CircuitBreaker('paytm', config.paytm_failure_threshold, config.paytm_reset_timeout)
+
+
+def _request(name, fn, details):
+    started = time.perf_counter()
+    try:
+        response = fn(details)
+    finally:
+        metrics.observe('paytm.' + name, time.perf_counter() - started)
+    logger.info(response)
+
+    # the sdk catches every exception, timeouts included, and returns it as
+    # a response of its own with this status. Paytm's own failures use others
+    result_info = response.get_response_object().get_body().get_result_info()
+    if result_info.get_result_status() == ErrorConstants.FAILURE:
+        metrics.incr('paytm.errors')
+        raise PaytmUnavailable(f'paytm {name} failed: {result_info.get_result_msg()}')
+
+    return response
+
+
+def available():
+    """
+    False while paytm failed so often lately that it would not be asked.
+    Lets callers skip work that is only useful if the call can happen
+    """
+    return not _breaker.is_open()
+
+
+def _call(name, fn, details):
+    try:
+        return _breaker.call(_request, name, fn, details, failure=PaytmUnavailable)
+    except CircuitOpen as e:
+        raise PaytmUnavailable(str(e))
+
+
 def initiate_transaction(user_id, txn_id, amount):
     channel_id = EChannelId.APP
     txn_amount = Money(EnumCurrency.INR, '%.2f' % amount)
@@ -63,29 +122,69 @@ def initiate_transaction(user_id, txn_id, amount):
     # but our unique transaction_id is called txn_id. it has nothing to
     # do with order id.
     builder = PaymentDetailsBuilder(channel_id, txn_id, txn_amount, user_info)
+    builder.set_read_timeout(config.paytm_read_timeout)
     payment_details = builder.build()
 
-    response = Payment.createTxnToken(payment_details)
-    logger.info(response)
+    response = _call('initiate', Payment.createTxnToken, payment_details)
     body = response.get_response_object().get_body()
 
+    if not body.txnToken:
+        raise PaytmUnavailable(f'paytm did not give a token: {body.get_result_info().get_result_msg()}')
+
     return body.txnToken, f'{callback_url}?ORDER_ID={txn_id}'
 
 
 def payment_status(txn_id):
+    """Raises PaytmUnavailable when paytm could not be asked"""
     builder = PaymentStatusDetailBuilder(txn_id)
+    builder.set_read_timeout(config.paytm_status_read_timeout)
 
-    response = Payment.getPaymentStatus(PaymentStatusDetail(builder))
-    logger.info(response)
+    response = _call('status', Payment.getPaymentStatus, PaymentStatusDetail(builder))
 
     result_code = response.get_response_object().get_body().resultInfo.resultCode
 
-    # 501 is technically a failure but paytm is returning 501 in my test response
-    # even though the app shows transaction successful
-    if result_code == '01' or result_code == '501':
+    if result_code == '01':
         return PaymentStatus.SUCCESSFUL
 
-    if result_code == '402' or result_code == '400':
+    # 501 is paytm's system error, the payment may still go through.
+    # (The sdk also reports its own failures as 501, those raise above)
+    if result_code == '402' or result_code == '400' or result_code == '501':
         return PaymentStatus.PENDING
 
     return PaymentStatus.FAILED
+
+
+# STATUS field of the callback paytm posts to callback_url
+_callback_statuses = {
+    'TXN_SUCCESS': PaymentStatus.SUCCESSFUL,
+    'PENDING': PaymentStatus.PENDING,
+    'TXN_FAILURE': PaymentStatus.FAILED,
+}
+
+
+def verify_callback(params):
+    """
+    True if the CHECKSUMHASH of the posted callback fields was made with our
+    merchant key. The checksum covers the values of every other field,
+    sorted by field name and joined with |
+    """
+    params = dict(params)
+    checksum = params.pop('CHECKSUMHASH', None)
+    if not checksum or params.get('MID') != merchant_id:
+        return False
+
+    values = []
+    for key in sorted(params):
+        value = params[key]
+        values.append('' if value is None or value.lower() == 'null' else value)
+
+    try:
+        return verifySignature('|'.join(values), merchant_key, checksum)
+    except (ValueError, TypeError, IndexError, UnicodeDecodeError):
+        # not something we encrypted
+        return False
+
+
+def callback_status(params):
+    """The PaymentStatus reported by a callback, INVALID if it is not one we know"""
+    return _callback_statuses.get(params.get('STATUS'), PaymentStatus.INVALID)
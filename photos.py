@@ -18,7 +18,7 @@ def get_photo():
     if not photo_id:
         return {'error': 'photo id not found'}, ValidationError
 
-    with connection() as conn, conn.cursor() as cur:
+    with connection(readonly=True) as conn, conn.cursor() as cur:
         cur.execute(
             'select mime_type, data from photos where id = %s',
             (photo_id,)
@@ -0,0 +1,166 @@
+"""
+Settles payments whose client never called update_payment_status.
+
+Every run picks the oldest transactions that are still not paid or pending
+and older than `reconcile_min_age`, asks paytm about them from a small
+thread pool (at most `reconcile_rate` calls a second), then writes the
+answers back to transactions and orders with one statement per status.
+No database connection is held while paytm answers.
+
+Runs from jobs.py. Reports in metrics -
+ - reconcile.checked, reconcile.<status>, reconcile.errors: counters
+ - reconcile.run: time taken by every run
+ - reconcile.lag_seconds: age of the oldest transaction in the last run
+ - reconcile.per_second: transactions checked per second in the last run
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import config
+import events
+import kitchen
+import metrics
+import paytm
+from db_utils import connection
+
+logger = logging.getLogger(__name__)
+
+
+class _RateLimiter:
+    """Lets at most `rate` calls a second through, across threads"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(self._next, now) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+_executor = ThreadPoolExecutor(max_workers=config.reconcile_workers, thread_name_prefix='reconcile')
+_limiter = _RateLimiter(config.reconcile_rate)
+
+
+def _claim_batch(now):
+    """
+    The transactions to check in this run. A run in another process may
+    pick the same candidates, so they are claimed with an update that only
+    takes rows nobody checked since - the update waits for the other run's
+    row locks and then sees its checked_at - and only the rows carrying
+    this run's claim are returned.
+    """
+    recheck_before = now - timedelta(seconds=config.reconcile_recheck)
+    claim = str(uuid4())
+
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            'select id from transactions '
+            'where payment_status in %s '
+            'and (created_at is null or created_at < %s) '
+            'and (checked_at is null or checked_at < %s) '
+            'order by created_at '
+            'limit %s',
+            (paytm.UnsettledStatuses, now - timedelta(seconds=config.reconcile_min_age),
+             recheck_before, config.reconcile_batch_size)
+        )
+        candidates = tuple(map(lambda row: row[0], cur.fetchall()))
+        if not candidates:
+            return []
+
+        cur.execute(
+            'update transactions set checked_at = %s, claimed_by = %s '
+            'where id in %s and (checked_at is null or checked_at < %s)',
+            (now, claim, candidates, recheck_before)
+        )
+        claimed = cur.rowcount
+        conn.commit()
+
+        if claimed == 0:
+            return []
+
+        cur.execute(
+            'select id, order_id, created_at from transactions '
+            'where id in %s and claimed_by = %s '
+            'order by created_at',
+            (candidates, claim)
+        )
+        return cur.fetchall()
+
+
+def _payment_status(txn_id):
+    _limiter.wait()
+    try:
+        return paytm.payment_status(txn_id)
+    except Exception:
+        logger.exception('could not get the status of transaction %s', txn_id)
+        metrics.incr('reconcile.errors')
+        return None
+
+
+def _save(transactions, statuses):
+    # transaction ids and order ids by their new status
+    by_status = defaultdict(lambda: ([], []))
+    for (txn_id, order_id, _), status in zip(transactions, statuses):
+        if status is not None:
+            by_status[status][0].append(txn_id)
+            by_status[status][1].append(order_id)
+            metrics.incr('reconcile.' + status.to_string())
+
+    if not by_status:
+        return
+
+    with connection() as conn, conn.cursor() as cur:
+        for status, (txn_ids, order_ids) in by_status.items():
+            # update_payment_status may have got there first
+            cur.execute(
+                'update transactions set payment_status = %s '
+                'where id in %s and payment_status in %s',
+                (status.value, tuple(txn_ids), paytm.UnsettledStatuses)
+            )
+            # an order can have several transactions, never undo the one that paid
+            cur.execute(
+                'update orders set payment_status = %s '
+                'where id in %s and payment_status <> %s',
+                (status.value, tuple(set(order_ids)), paytm.PaymentStatus.SUCCESSFUL.value)
+            )
+            kitchen.payment_changed(cur, set(order_ids), status)
+        conn.commit()
+
+    for status, (txn_ids, order_ids) in by_status.items():
+        for txn_id, order_id in zip(txn_ids, order_ids):
+            events.publish(events.PaymentUpdated(order_id, txn_id, status))
+
+
+def reconcile():
+    """Checks one batch of unsettled transactions. Returns how many were checked"""
+    started = time.perf_counter()
+    now = datetime.utcnow()
+
+    transactions = _claim_batch(now)
+    if transactions:
+        statuses = list(_executor.map(lambda row: _payment_status(row[0]), transactions))
+        _save(transactions, statuses)
+
+    elapsed = time.perf_counter() - started
+    metrics.observe('reconcile.run', elapsed)
+    metrics.incr('reconcile.checked', len(transactions))
+    metrics.gauge('reconcile.per_second', len(transactions) / elapsed)
+
+    created = [row[2] for row in transactions if row[2] is not None]
+    metrics.gauge('reconcile.lag_seconds', (now - min(created)).total_seconds() if created else 0)
+
+    if transactions:
+        logger.info('reconciled %d transactions in %.1fs', len(transactions), elapsed)
+    return len(transactions)
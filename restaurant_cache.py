@@ -0,0 +1,96 @@
+"""
+In process cache of the restaurant details nearly every endpoint checks
+first - who owns it, its tax and which tables it has.
+
+Endpoints that change them call invalidate() after committing. Other
+server processes only notice once their entry expires, so the ttl is kept
+short, and orders are inserted with their table read from the database
+rather than taken from here.
+"""
+import hashlib
+from collections import namedtuple
+
+import config
+from cache import TTLCache
+from db_utils import connection
+
+# tables is a tuple of (id, name). tables_etag changes whenever they do
+Restaurant = namedtuple('Restaurant', ['id', 'name', 'admin_id', 'tax_percent', 'table_ids', 'tables', 'tables_etag'])
+
+_restaurants = TTLCache('restaurant_cache', config.restaurant_cache_size, config.restaurant_cache_ttl)
+_admin_restaurants = TTLCache('admin_restaurant_cache', config.restaurant_cache_size, config.restaurant_cache_ttl)
+
+
+def get(conn, restaurant_id):
+    """
+    Returns the Restaurant with the given id, or None if it does not exist.
+    When conn is None a connection is only opened if it is not cached.
+    """
+    restaurant = _restaurants.get(restaurant_id)
+    if restaurant is not None:
+        return restaurant
+
+    if conn is None:
+        with connection() as conn:
+            return _load(conn, restaurant_id)
+
+    return _load(conn, restaurant_id)
+
+
+def _load(conn, restaurant_id):
+    with conn.cursor() as cur:
+        cur.execute(
+            'select id, name, admin_id, tax_percent from restaurant where id = %s',
+            (restaurant_id,)
+        )
+        if cur.rowcount == 0:
+            return None
+        id, name, admin_id, tax_percent = cur.fetchone()
+
+        cur.execute('select id, name from tables where restaurant_id = %s', (restaurant_id,))
+        tables = tuple(cur.fetchall())
+
+    table_ids = frozenset(map(lambda table: table[0], tables))
+    tables_etag = hashlib.sha1(repr(tables).encode('utf-8')).hexdigest()
+
+    restaurant = Restaurant(id, name, admin_id, tax_percent, table_ids, tables, tables_etag)
+    _restaurants.set(restaurant_id, restaurant)
+    return restaurant
+
+
+def is_owner(conn, restaurant_id, admin_id):
+    restaurant = get(conn, restaurant_id)
+    return restaurant is not None and restaurant.admin_id == admin_id
+
+
+def has_table(conn, restaurant_id, table_id):
+    restaurant = get(conn, restaurant_id)
+    try:
+        return restaurant is not None and int(table_id) in restaurant.table_ids
+    except ValueError:
+        return False
+
+
+def restaurant_ids(conn, admin_id):
+    """
+    Ids of the restaurants administered by admin_id, as a tuple so that it
+    can be used in an "in %s" clause.
+    """
+    ids = _admin_restaurants.get(admin_id)
+    if ids is not None:
+        return ids
+
+    with conn.cursor() as cur:
+        cur.execute('select id from restaurant where admin_id = %s', (admin_id,))
+        ids = tuple(map(lambda row: row[0], cur.fetchall()))
+
+    _admin_restaurants.set(admin_id, ids)
+    return ids
+
+
+def invalidate(restaurant_id):
+    _restaurants.pop(restaurant_id)
+
+
+def invalidate_admin(admin_id):
+    _admin_restaurants.pop(admin_id)
@@ -0,0 +1,322 @@
+"""
+An embedded sqlite stand in for mysql, so that the app can be run and
+benchmarked on one machine without any database server.
+
+Start the app with DB_BACKEND=sqlite (and optionally SQLITE_PATH). The schema
+is created from migrations/ the first time a connection is made.
+SQLITE_LATENCY_MS adds a delay to every statement to stand in for the
+network round trip to a real database server when benchmarking.
+
+The endpoints are written for mysql through pymysql. Connections made here
+look like pymysql connections to them -
+ - %s / %(name)s parameters, including tuples for "in %s"
+ - last_insert_id(), on duplicate key update, DATE_SUB, now() and version()
+ - cur.rowcount is the number of rows for select statements
+ - pymysql.cursors.DictCursor, including "table.column" keys for repeated names
+ - numeric columns come back as Decimal and timestamps as datetime
+ - errors are raised as pymysql errors so the endpoints' except clauses work
+"""
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal
+from functools import lru_cache
+
+import pymysql
+
+import config
+
+# every numeric column in the schema is numeric(7, 2)
+_cents = Decimal('0.01')
+
+sqlite3.register_converter('timestamp', lambda value: datetime.fromisoformat(value.decode()))
+sqlite3.register_converter('numeric', lambda value: Decimal(value.decode()).quantize(_cents))
+
+_DialectRules = [
+    # ddl
+    (re.compile(r'\bserial\s+primary\s+key\b', re.I), 'integer primary key autoincrement'),
+    (re.compile(r'\bdefault\s+now\(\)', re.I), 'default current_timestamp'),
+    # functions
+    (re.compile(r'^\s*select\s+version\(\)\s*$', re.I), 'select sqlite_version()'),
+    (re.compile(r'DATE_SUB\(\s*CURDATE\(\)\s*,\s*INTERVAL\s+(\d+)\s+(DAY|HOUR|MINUTE|SECOND)\s*\)', re.I),
+     r"date('now', '-\1 \2')"),
+    (re.compile(r'DATE_SUB\(\s*NOW\(\)\s*,\s*INTERVAL\s+(\d+)\s+(DAY|HOUR|MINUTE|SECOND)\s*\)', re.I),
+     r"datetime('now', '-\1 \2')"),
+    (re.compile(r'\bnow\(\)', re.I), "datetime('now')"),
+    # sqlite's max() with several arguments is mysql's greatest()
+    (re.compile(r'\bgreatest\(', re.I), 'max('),
+    (re.compile(r'^\s*explain\s+', re.I), 'explain query plan '),
+]
+
+_OnDuplicateKey = re.compile(r'\bon\s+duplicate\s+key\s+update\b', re.I)
+_Values = re.compile(r'\bvalues\s*\(\s*(\w+)\s*\)', re.I)
+_Placeholder = re.compile(r'%%|%s|%\((\w+)\)s')
+
+
+@lru_cache(maxsize=512)
+def translate(query):
+    """Rewrites the mysql specific parts of a query. Parameters are left alone"""
+    for pattern, replacement in _DialectRules:
+        query = pattern.sub(replacement, query)
+
+    match = _OnDuplicateKey.search(query)
+    if match:
+        # in the update part, values(col) means the value we tried to insert
+        update = _Values.sub(r'excluded.\1', query[match.end():])
+        query = query[:match.start()] + 'on conflict do update set' + update
+
+    return query
+
+
+def _adapt(value):
+    if value is None or isinstance(value, (int, float, str, bytes)):
+        return value
+    if isinstance(value, Decimal):
+        return float(value)
+    # uuid and anything else pymysql would have sent as a string
+    return str(value)
+
+
+def bind(query, args):
+    """
+    Turns pymysql style parameters into sqlite ones. A tuple or list
+    parameter becomes (?, ?, ...) just like pymysql renders it for "in %s".
+    """
+    if args is None:
+        # like pymysql, a query without parameters is sent untouched
+        return query, ()
+
+    if not isinstance(args, (tuple, list, dict)):
+        args = (args,)
+
+    positional = iter(args) if not isinstance(args, dict) else None
+    params = []
+
+    def substitute(match):
+        if match.group(0) == '%%':
+            return '%'
+
+        value = args[match.group(1)] if match.group(1) else next(positional)
+        if isinstance(value, (tuple, list)):
+            params.extend(map(_adapt, value))
+            return '(' + ', '.join('?' * len(value)) + ')'
+
+        params.append(_adapt(value))
+        return '?'
+
+    return _Placeholder.sub(substitute, query), params
+
+
+def _split_top_level(text):
+    parts, depth, current = [], 0, ''
+    for char in text:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            parts.append(current)
+            current = ''
+            continue
+        current += char
+    parts.append(current)
+    return [part.strip() for part in parts]
+
+
+@lru_cache(maxsize=512)
+def _selected_tables(query):
+    """
+    Table of every column in the select list, or None when it is not a plain
+    table.column. sqlite does not report it, pymysql uses it for dict keys.
+    """
+    match = re.search(r'^\s*select\s+(.*?)\s+from\s', query, re.I | re.S)
+    if not match:
+        return ()
+
+    tables = []
+    for expression in _split_top_level(match.group(1)):
+        column = re.fullmatch(r'(\w+)\.\w+', expression)
+        tables.append(column.group(1) if column else None)
+    return tuple(tables)
+
+
+def _convert(row):
+    # numeric columns are converted by sqlite3 itself, this catches
+    # expressions over them like sum(price)
+    return tuple(
+        Decimal(repr(value)).quantize(_cents) if isinstance(value, float) else value
+        for value in row
+    )
+
+
+class SqliteCursor:
+    def __init__(self, connection, dict_rows):
+        self._connection = connection
+        self._conn = connection._conn
+        self._dict_rows = dict_rows
+        self._rows = []
+        self._index = 0
+        self.rowcount = -1
+        self.lastrowid = None
+        self.description = None
+
+    def execute(self, query, args=None):
+        translated = translate(query)
+        sql, params = bind(translated, args)
+
+        if config.sqlite_latency:
+            # pretend the database is across a network, every statement is a round trip
+            time.sleep(config.sqlite_latency)
+
+        try:
+            cursor = self._conn.execute(sql, params)
+        except sqlite3.IntegrityError as e:
+            raise pymysql.err.IntegrityError(str(e))
+        except sqlite3.OperationalError as e:
+            raise pymysql.err.OperationalError(str(e))
+        except sqlite3.Error as e:
+            raise pymysql.err.DatabaseError(str(e))
+
+        self.description = cursor.description
+        self.lastrowid = cursor.lastrowid
+        self._index = 0
+
+        if cursor.rowcount > 0 and re.match(r'\s*insert\b', sql, re.I):
+            # mysql's last_insert_id() is the id of the first row a multi row
+            # insert added. sqlite numbers them one after the other
+            self._connection.last_insert_id = cursor.lastrowid - cursor.rowcount + 1
+
+        if cursor.description is None:
+            self._rows = []
+            self.rowcount = cursor.rowcount
+        else:
+            # pymysql buffers the whole result and reports its size
+            keys = self._keys(translated) if self._dict_rows else None
+            self._rows = [
+                dict(zip(keys, _convert(row))) if keys else _convert(row)
+                for row in cursor.fetchall()
+            ]
+            self.rowcount = len(self._rows)
+
+        return self.rowcount
+
+    def executemany(self, query, args):
+        args = list(args)
+        if not args:
+            return 0
+
+        # like pymysql, an insert ... values (...) is sent as one multi row
+        # insert rather than a statement per row
+        match = pymysql.cursors.RE_INSERT_VALUES.match(query)
+        if match and not isinstance(args[0], dict):
+            prefix, values, postfix = match.group(1, 2, 3)
+            return self.execute(
+                prefix + ', '.join([values] * len(args)) + postfix,
+                [value for row in args for value in row]
+            )
+
+        rowcount = 0
+        for row in args:
+            rowcount += self.execute(query, row)
+        self.rowcount = rowcount
+        return rowcount
+
+    def _keys(self, query):
+        tables = _selected_tables(query)
+        keys = []
+        for i, column in enumerate(self.description):
+            name = column[0]
+            if name in keys and i < len(tables) and tables[i]:
+                name = tables[i] + '.' + name
+            keys.append(name)
+
+        return keys
+
+    def fetchone(self):
+        if self._index >= len(self._rows):
+            return None
+        row = self._rows[self._index]
+        self._index += 1
+        return row
+
+    def fetchall(self):
+        rows = self._rows[self._index:]
+        self._index = len(self._rows)
+        return rows
+
+    def fetchmany(self, size=1):
+        rows = self._rows[self._index:self._index + size]
+        self._index += len(rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SqliteConnection:
+    def __init__(self, path):
+        self._conn = sqlite3.connect(
+            path,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            # the pool hands a connection to one thread at a time
+            check_same_thread=False,
+            timeout=30,
+        )
+        self._conn.execute('pragma journal_mode = wal')
+        self._conn.execute('pragma synchronous = normal')
+
+        self.last_insert_id = 0
+        self._conn.create_function('last_insert_id', 0, lambda: self.last_insert_id)
+
+    def cursor(self, cursor=None):
+        dict_rows = cursor is not None and issubclass(cursor, pymysql.cursors.DictCursorMixin)
+        return SqliteCursor(self, dict_rows)
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def ping(self, reconnect=False):
+        try:
+            self._conn.execute('select 1')
+        except sqlite3.Error as e:
+            raise pymysql.err.OperationalError(str(e))
+
+    def close(self):
+        self._conn.close()
+
+
+_migrated = set()
+_migrate_lock = threading.Lock()
+
+
+# what connections made here can raise. Statements raise pymysql errors,
+# rollback() and close() pass sqlite's own through
+Errors = (pymysql.Error, sqlite3.Error)
+
+
+def connect(path):
+    conn = SqliteConnection(path)
+
+    if path not in _migrated:
+        with _migrate_lock:
+            if path not in _migrated:
+                # imported here because migrate imports db_utils which imports us
+                import migrate
+                migrate.apply_pending(conn)
+                _migrated.add(path)
+
+    return conn
@@ -1,17 +1,27 @@
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
 from uuid import uuid4
-import bcrypt
 import jwt
 import pymysql
 import requests
 from apscheduler.schedulers.background import BackgroundScheduler
-from email_validator import EmailNotValidError, validate_email
+from email_validator import EmailNotValidError
 from flask import Blueprint, request
 from jwt import InvalidSignatureError
 from pytz import timezone
 
+import events
+import jwt_cache
+import http_cache
+import idempotency
+import kitchen
+import menu_cache
 import paytm
+import restaurant_cache
 from config import jwt_secret, merchant_id
-from db_utils import connection
+from db_utils import connection, pin_to_primary
+from emails import validate_login_email, validate_signup_email
+from passwords import hash_password, password_valid, needs_rehash, PasswordHasherBusy
 
 MinPasswordLength = 5
 
@@ -41,14 +51,6 @@ ValidationError = 200
 MaxPasswordLength = 70
 
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-
-
-def password_valid(password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
-
-
 @user.route('/dummy')
 def dummy():
     return ''
@@ -102,16 +104,19 @@ def create_user():
         email = str(request.json['email']).strip()
         try:
             # validating email and assigning the valid email back to email
-            email = validate_email(email).email
+            email = validate_signup_email(email)
         except EmailNotValidError:
             print('email not valid')
             return {'error': 'email is not valid'}
 
+        # hashed before taking a connection, it may have to wait for a bcrypt worker
+        password_hash = hash_password(password)
+
         with connection() as conn, conn.cursor() as cur:
             user_id = str(uuid4())
             cur.execute(
                 'insert into users values(%s, %s, %s, %s)',
-                (user_id, name, email, hash_password(password)),
+                (user_id, name, email, password_hash),
             )
             conn.commit()
 
@@ -168,7 +173,7 @@ def authenticate():
 
         try:
             # validating email and assigning the valid email back to email
-            email = validate_email(email).email
+            email = validate_login_email(email)
         except EmailNotValidError:
             print('email is not valid')
             return {'error': 'email is not valid'}, ValidationError
@@ -189,15 +194,29 @@ def authenticate():
             user_id = row[0]
             hashed_password = row[1]
 
-            if password_valid(password, hashed_password):
-                jwt_token = jwt.encode({'user_id': user_id}, jwt_secret, algorithm='HS256')
+        # the connection is back in the pool while bcrypt runs
+        if not password_valid(password, hashed_password):
+            return {'error': 'Invalid email or password'}
 
-                return {
-                    'jwt_token': jwt_token,
-                }
+        if needs_rehash(hashed_password):
+            # the work factor went up since this hash was made. Now is
+            # the only time we have the password to upgrade it
+            try:
+                password_hash = hash_password(password)
+                with connection() as conn, conn.cursor() as cur:
+                    cur.execute(
+                        'update users set password_hash = %s where id = %s',
+                        (password_hash, user_id)
+                    )
+                    conn.commit()
+            except PasswordHasherBusy:
+                pass
+
+        jwt_token = jwt.encode({'user_id': user_id}, jwt_secret, algorithm='HS256')
 
-            # if password is not valid
-            return {'error': 'Invalid email or password'}
+        return {
+            'jwt_token': jwt_token,
+        }
     except KeyError:
         print('Invalid input. One or more parameters absent')
         return {'error': 'Invalid input. One or more parameters absent'}, ValidationError
@@ -213,7 +232,7 @@ def validate_token():
 # decodes user id. In case of error, returns None
 def _decoded_user_id(_request):
     try:
-        return jwt.decode(_request.headers['X-Auth-Token'], jwt_secret, algorithms=['HS256'])['user_id']
+        return jwt_cache.decode(_request.headers['X-Auth-Token'])['user_id']
     except InvalidSignatureError:
         return None
     except KeyError:
@@ -257,40 +276,55 @@ def get_menu():
         print('restaurant id missing')
         return {'error': 'Invalid input. One or more parameters absent'}, ValidationError
 
-    with connection() as conn, conn.cursor() as cur:
-        cur.execute('select name from restaurant where id = %s', (restaurant_id,))
+    # only touches the database when the menu is not cached
+    cached_menu = menu_cache.get(restaurant_id)
 
-        if cur.rowcount == 0:
-            print('restaurant id does not exist')
-            return {'error': 'Restaurant does not exist'}, ValidationError
+    if cached_menu is None:
+        print('restaurant id does not exist')
+        return {'error': 'Restaurant does not exist'}, ValidationError
 
-        restaurant = cur.fetchone()[0]
+    if cached_menu.payload is None:
+        response = http_cache.not_modified(cached_menu.etag)
+        if response:
+            return response
 
-        cur.execute(
-            'select id, name, description, photo_url, price '
-            'from menu '
-            'where restaurant_id = %s and active_menu = 0',
-            (restaurant_id,)
-        )
+        return http_cache.cacheable(menu_cache.response_body(cached_menu), cached_menu.etag)
 
-        menu = []
+    # the response is already encoded, send the bytes as they are
+    use_gzip = cached_menu.gzipped is not None and 'gzip' in request.accept_encodings
+    # the gzipped response is a different representation, so it gets its own etag
+    etag = cached_menu.etag + '-gzip' if use_gzip else cached_menu.etag
+
+    response = http_cache.not_modified(etag)
+    if not response:
+        response = http_cache.cacheable(cached_menu.gzipped if use_gzip else cached_menu.payload, etag)
+        response.content_type = 'application/json'
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+
+    response.vary.add('Accept-Encoding')
+    return response
 
-        for id, name, description, photo_url, price in cur.fetchall():
-            menu.append(
-                {
-                    'id': id,
-                    'name': name,
-                    'description': description,
-                    'photo_url': photo_url,
-                    # price is stored as decimal during conversion
-                    # which cannot be converted to json by default.
-                    # So I am converting it to float which can be
-                    # used in json
-                    'price': float(price),
-                }
-            )
 
-        return {'menu': menu, 'restaurant': restaurant}
+def _insert_order(cur, order_id, user_id, restaurant_id, table):
+    """
+    Inserts an unpaid order for the table. Returns False, inserting nothing,
+    when the restaurant has no such table. restaurant_cache can still have a
+    table that another server process deleted, so the insert takes the table
+    from the database, which checks it at no extra round trip. A table found
+    missing is dropped from this process's cache too.
+    """
+    cur.execute(
+        "insert into orders(id, user_id, table_id, restaurant_id, payment_status, "
+        "price_excluding_tax, tax, total) "
+        "select %s, %s, id, restaurant_id, %s, 0, 0, 0 from tables "
+        "where id = %s and restaurant_id = %s",
+        (order_id, user_id, paytm.PaymentStatus.NOT_PAID.value, table, restaurant_id),
+    )
+    if cur.rowcount == 0:
+        restaurant_cache.invalidate(restaurant_id)
+        return False
+    return True
 
 
 @user.route("/order", methods=["POST"])
@@ -299,6 +333,9 @@ def create_order():
     Create an order.
     url - /api/v1/order?restaurant_id=<restaurant id>&table=<table>
     Headers - X-Auth-Token: <jwt>
+              Idempotency-Key: <optional, any unique string up to 64 characters>
+    A retry with the same Idempotency-Key gets the first response back
+    instead of creating another order.
     Sample error -
     {
         "error": "reason for error"
@@ -315,6 +352,15 @@ def create_order():
             print('Authentication failure')
             return {'error': 'Authentication failure'}, ValidationError
 
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key is not None and not idempotency.valid_key(idempotency_key):
+            print('Invalid idempotency key')
+            return {'error': 'Invalid Idempotency-Key'}, ValidationError
+
+        replayed = idempotency.replay(user_id, 'order', idempotency_key)
+        if replayed is not None:
+            return replayed
+
         table = request.args.get('table')
         if not table:
             print('Table absent')
@@ -326,37 +372,28 @@ def create_order():
             return {'error': 'restaurant id not found'}, ValidationError
 
         with connection() as conn, conn.cursor() as cur:
-            cur.execute(
-                'select tax_percent from restaurant where id = %s',
-                (restaurant_id,)
-            )
+            restaurant = restaurant_cache.get(conn, restaurant_id)
 
-            if cur.rowcount == 0:
+            if restaurant is None:
                 print('Restaurant id does not exist')
                 return {'error': 'Restaurant id does not exist'}, ValidationError
 
-            tax_percent = float(cur.fetchone()[0])
+            tax_percent = float(restaurant.tax_percent)
 
-            cur.execute(
-                'select name from tables '
-                'where restaurant_id = %s and id = %s',
-                (restaurant_id, table)
-            )
+            order_id = str(uuid4())
 
-            if cur.rowcount == 0:
+            if not _insert_order(cur, order_id, user_id, restaurant_id, table):
                 print('Table not found')
                 return {'error': 'Table not found'}, ValidationError
 
-            order_id = str(uuid4())
+            created = {'order_id': order_id, 'tax_percent': tax_percent}
+            response = idempotency.commit(conn, user_id, 'order', idempotency_key, created)
+            pin_to_primary(user_id)
 
-            cur.execute(
-                "insert into orders(id, user_id, table_id, restaurant_id, payment_status) "
-                "values(%s, %s, %s, %s, %s)",
-                (order_id, user_id, table, restaurant_id, paytm.PaymentStatus.NOT_PAID.value),
-            )
-
-            conn.commit()
-        return {'order_id': order_id, 'tax_percent': tax_percent}
+        # a retry that lost the race gets the first response and nothing was written
+        if response is created:
+            events.publish(events.OrderCreated(order_id, restaurant_id, user_id, table))
+        return response
     except KeyError:
         print('Invalid input. One or more parameters absent')
         return {'error': 'Invalid input. One or more parameters absent'}, ValidationError
@@ -364,6 +401,30 @@ def create_order():
 
 @user.route('/checkout', methods=['POST'])
 def checkout():
+    """
+    Starts the payment of an order.
+    url - /api/v1/checkout?order_id=<order id>
+    Headers - X-Auth-Token: <jwt>
+
+    Runs in three steps so that no database connection is held while paytm
+    answers -
+    1. a transaction row for the order total is committed
+    2. paytm is asked for a transaction token
+    3. the token is recorded on the transaction row
+    While paytm is known to be down nothing is written. When paytm fails
+    the transaction is marked failed. If the server dies between the steps
+    it stays not paid without a token, nothing can be charged against it
+    and the next checkout starts a new one.
+
+    Sample output -
+    {
+        "txn_id": "<transaction id>",
+        "m_id": "<merchant id>",
+        "token": "<paytm transaction token>",
+        "callback_url": "<url>",
+        "amount": "262.50"
+    }
+    """
     order_id = request.args.get('order_id')
     if not order_id:
         print('order id not found')
@@ -374,9 +435,12 @@ def checkout():
         print('Authentication failure')
         return {'error': 'Authentication failure'}, ValidationError
 
+    if not paytm.available():
+        raise paytm.PaytmUnavailable('paytm circuit breaker is open')
+
     with connection() as conn, conn.cursor() as cur:
         cur.execute(
-            'select user_id, payment_status, restaurant_id from orders '
+            'select user_id, payment_status, price_excluding_tax, total from orders '
             'where id = %s',
             (order_id,)
         )
@@ -388,7 +452,8 @@ def checkout():
         row = cur.fetchone()
         user_id_who_created_the_order = row[0]
         payment_status = row[1]
-        restaurant_id = row[2]
+        price = row[2]
+        total_price = row[3]
 
         if user_id != user_id_who_created_the_order:
             print('user id not the same as the person as user id who created the order')
@@ -398,59 +463,79 @@ def checkout():
             print('Order has already been paid for')
             return {'error': 'Order has already been paid'}, ValidationError
 
-        cur.execute(
-            'select sum(price) from order_items where order_id = %s',
-            (order_id,)
-        )
-
-        price = cur.fetchone()[0]
-        # sum should return 0 for empty list. But it is somehow returning None
+        # kept up to date by order_items
         if price == 0 or price is None:
             print('no order items found')
             return {'error': 'Please book something before checking out'}, ValidationError
 
-        cur.execute(
-            'select tax_percent from restaurant where id = %s',
-            (restaurant_id,)
-        )
-
-        tax_percent = cur.fetchone()[0]
-        tax = price * tax_percent / 100
-        total_price = price + tax
-
-        cur.execute(
-            'update orders set tax = %s where id = %s',
-            (tax, order_id)
-        )
-
         txn_id = str(uuid4())
         cur.execute(
-            'insert into transactions(id, order_id, price, payment_status) '
-            'values (%s, %s, %s, %s)',
-            (txn_id, order_id, total_price, paytm.PaymentStatus.NOT_PAID.value)
+            'insert into transactions(id, order_id, price, payment_status, created_at) '
+            'values (%s, %s, %s, %s, %s)',
+            (txn_id, order_id, total_price, paytm.PaymentStatus.NOT_PAID.value, datetime.utcnow())
         )
 
+        conn.commit()
+        pin_to_primary(user_id)
+    events.publish(events.CheckoutStarted(order_id, txn_id, total_price))
+
+    # the connection is back in the pool before paytm is called
+    try:
         txn_token, callback_url = paytm.initiate_transaction(user_id, txn_id, total_price)
+    except Exception as e:
+        print('Could not initiate paytm transaction %s: %s' % (txn_id, e))
+        if _set_transaction_status(txn_id, paytm.PaymentStatus.FAILED):
+            events.publish(events.PaymentUpdated(order_id, txn_id, paytm.PaymentStatus.FAILED))
+        # the app answers it with the same 503 as every other paytm outage
+        if isinstance(e, paytm.PaytmUnavailable):
+            raise
+        return {'error': 'Could not start the payment. Please try again'}, 503
 
-        conn.commit()
+    try:
+        with connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                'update transactions set txn_token = %s where id = %s',
+                (txn_token, txn_id)
+            )
+            conn.commit()
+    except pymysql.err.Error as e:
+        # the payment can go ahead without it, the status is looked up by txn_id
+        print('Could not record the token of transaction %s: %s' % (txn_id, e))
+
+    return {
+        'txn_id': txn_id,
+        'm_id': merchant_id,
+        'token': txn_token,
+        'callback_url': callback_url,
+        'amount': str(total_price)
+    }
 
-        return {
-            'txn_id': txn_id,
-            'm_id': merchant_id,
-            'token': txn_token,
-            'callback_url': callback_url,
-            'amount': str(total_price)
-        }
+
+def _set_transaction_status(txn_id, payment_status):
+    """Returns whether the status was recorded"""
+    try:
+        with connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                'update transactions set payment_status = %s where id = %s',
+                (payment_status.value, txn_id)
+            )
+            conn.commit()
+            return cur.rowcount > 0
+    except pymysql.err.Error as e:
+        # it stays not paid, which nobody can pay against without a token either
+        print('Could not update the status of transaction %s: %s' % (txn_id, e))
+        return False
 
 
 @user.route('/update_payment_status', methods=['POST'])
 def update_payment_status():
     """
     Updates transaction status for the given transaction id
-    url - /api/v1/update_payment_status?txn_id=<txn_id>?status=<int>
+    url - /api/v1/update_payment_status?txn_id=<txn_id>
     Headers - X-Auth-Token: <jwt>
 
-    status can be one of payment status described below
+    Paytm reports most payments to /paytm_callback on its own, then this
+    answers from the database without asking paytm again.
 
     Sample output -
     {
@@ -505,28 +590,94 @@ def update_payment_status():
                 and payment_status != paytm.PaymentStatus.PENDING.value:
             return {'success': payment_status == paytm.PaymentStatus.SUCCESSFUL.value}
 
-        status = request.args.get('status')
-        # cannot use "if not status" here because status of 0 will go to false
-        if status is not None:
-            updated_payment_status = paytm.PaymentStatus.parse(status)
-        else:
-            updated_payment_status = paytm.payment_status(txn_id)
+        # a status sent by the client is not trusted, only paytm's
+        updated_payment_status = paytm.payment_status(txn_id)
 
-        cur.execute(
-            'update transactions set payment_status = %s where id = %s',
-            (updated_payment_status.value, txn_id)
-        )
+        settled = _settle_transaction(cur, txn_id, order_id, updated_payment_status)
+        conn.commit()
+        pin_to_primary(user_id)
+        if settled:
+            events.publish(events.PaymentUpdated(order_id, txn_id, updated_payment_status))
+
+        return {
+            'payment_status': updated_payment_status.value
+        }
+
+
+def _settle_transaction(cur, txn_id, order_id, payment_status):
+    """
+    Records the new status of a transaction that was not paid or pending,
+    and of its order. A transaction that is already settled is left alone,
+    so the same news arriving twice changes nothing. Returns whether the
+    transaction was settled now.
+    """
+    cur.execute(
+        'update transactions set payment_status = %s '
+        'where id = %s and payment_status in %s',
+        (payment_status.value, txn_id, paytm.UnsettledStatuses)
+    )
+    if cur.rowcount == 0:
+        return False
+
+    # an order can have several transactions, never undo the one that paid
+    cur.execute(
+        'update orders set payment_status = %s '
+        'where id = %s and payment_status <> %s',
+        (payment_status.value, order_id, paytm.PaymentStatus.SUCCESSFUL.value)
+    )
+    kitchen.payment_changed(cur, (order_id,), payment_status)
+    return True
+
+
+@user.route('/paytm_callback', methods=['POST'])
+def paytm_callback():
+    """
+    Paytm posts the result of a payment here, this is the callback_url
+    given to it in checkout. Set CALLBACK_URL to <server>/api/v1/paytm_callback
+    Input - form fields from paytm, among them ORDERID (our txn_id), MID,
+    STATUS, TXNAMOUNT and CHECKSUMHASH
+    Sample output -
+    {
+        "payment_status": <payment_status>
+    }
+    Paytm may deliver the same callback more than once, only the first one
+    changes anything.
+    """
+    params = request.form.to_dict()
 
+    if not paytm.verify_callback(params):
+        print('Invalid paytm checksum')
+        return {'error': 'Invalid checksum'}, ValidationError
+
+    txn_id = params.get('ORDERID')
+
+    with connection() as conn, conn.cursor() as cur:
         cur.execute(
-            'update orders set payment_status = %s where id = %s',
-            (updated_payment_status.value, order_id)
+            'select order_id, price from transactions where id = %s',
+            (txn_id,)
         )
 
+        if cur.rowcount == 0:
+            print('Transaction id does not exist')
+            return {'error': 'Transaction id does not exist'}, ValidationError
+
+        order_id, price = cur.fetchone()
+
+        payment_status = paytm.callback_status(params)
+        try:
+            if Decimal(params.get('TXNAMOUNT')) != price:
+                print('Amount paid for transaction %s does not match %s' % (txn_id, price))
+                payment_status = paytm.PaymentStatus.INVALID
+        except (TypeError, InvalidOperation):
+            payment_status = paytm.PaymentStatus.INVALID
+
+        settled = _settle_transaction(cur, txn_id, order_id, payment_status)
         conn.commit()
+        if settled:
+            events.publish(events.PaymentUpdated(order_id, txn_id, payment_status))
 
-        return {
-            'payment_status': updated_payment_status.value
-        }
+        cur.execute('select payment_status from transactions where id = %s', (txn_id,))
+        return {'payment_status': cur.fetchone()[0]}
 
 
 class Order:
@@ -542,12 +693,103 @@ class Order:
                and (0 < self.quantity < 16)
 
 
+def _parse_basket(order_id, order_list):
+    """
+    Returns (orders, None) for a valid order_list, otherwise (None, reason)
+    """
+    all_orders = list(map(lambda json: Order(order_id, int(json["menu_id"]), json["quantity"]), order_list))
+
+    if len(all_orders) == 0:
+        print('no orders found')
+        return None, 'order items cannot be empty'
+
+    for order in all_orders:
+        if not order.is_valid():
+            print('invalid input. menu id: ' + str(order.menu_id) + '\t quantity: ' + str(order.quantity))
+            return None, 'Invalid input'
+
+    menu_ids = list(map(lambda order: order.menu_id, all_orders))
+
+    if len(set(menu_ids)) != len(menu_ids):
+        print('menu id repeated: %s' % menu_ids)
+        return None, 'Menu id cannot be repeated'
+
+    return all_orders, None
+
+
+def _price_basket(menu, all_orders):
+    """
+    Sets the price of every order from the restaurant's menu. Returns the
+    reason when an item cannot be ordered, otherwise None
+    """
+    # the restaurant was deleted since the order was made or checked
+    if menu is None:
+        print('Restaurant id does not exist')
+        return 'Restaurant id does not exist'
+
+    items = menu.items
+
+    if any(order.menu_id in items and not items[order.menu_id].active for order in all_orders):
+        return "Can't order Disabled Items."
+
+    if any(order.menu_id not in items for order in all_orders):
+        print('One or more menu ides does not exist')
+        return 'One or more menu ids does not exist'
+
+    for order in all_orders:
+        order.price = float(items[order.menu_id].price) * order.quantity
+        print('menu id: ' + str(order.menu_id))
+        print('price: ' + str(items[order.menu_id].price))
+
+    return None
+
+
+def insert_order_items(cur, order_id, restaurant_id, all_orders, tax_percent):
+    """
+    Writes the basket with the same few statements whatever its size - the
+    order items, the order totals and the kitchen tickets. Returns False,
+    and the transaction has to be rolled back, when an item turned out not
+    to be orderable. The basket was checked against menu_cache, which can
+    still have items another server process disabled.
+    """
+    # executemany turns these into one multi row insert each. The update
+    # clause has to use values(col) rather than its own %s parameters,
+    # pymysql only formats the values (...) part with each row's parameters
+    cur.executemany(
+        "insert into order_items(order_id, menu_id, quantity, price) values (%s,%s,%s,%s) "
+        "on duplicate key update quantity = quantity + values(quantity), price = price + values(price)",
+        [(order.order_id, order.menu_id, order.quantity, order.price) for order in all_orders]
+    )
+
+    price_excluding_tax = sum(map(lambda o: o.price, all_orders))
+    # tax and total come first and only use the old price_excluding_tax.
+    # mysql evaluates the assignments left to right with the values already
+    # set, sqlite with the old ones, this way both get the same result
+    cur.execute(
+        "update orders set "
+        "tax = round((price_excluding_tax + %(price)s) * %(tax_percent)s / 100.0, 2), "
+        "total = price_excluding_tax + %(price)s + round((price_excluding_tax + %(price)s) * %(tax_percent)s / 100.0, 2), "
+        "price_excluding_tax = price_excluding_tax + %(price)s "
+        "where id = %(order_id)s",
+        {'price': price_excluding_tax, 'tax_percent': tax_percent, 'order_id': order_id}
+    )
+
+    # last, as it locks the restaurant's kitchen_versions row until the commit
+    if not kitchen.add_tickets(cur, restaurant_id, all_orders):
+        menu_cache.invalidate(restaurant_id)
+        return False
+    return True
+
+
 @user.route("/order_items", methods=['POST'])
 def order_items():
     """
     Add items to order.
     url - /api/v1/order_items?order_id=jhcvxjdsvydsgvfshgho
     Headers - X-Auth-Token: <jwt>
+              Idempotency-Key: <optional, any unique string up to 64 characters>
+    A retry with the same Idempotency-Key gets the first response back
+    instead of adding the items again.
     sample input -
     {
         "order_list": [
@@ -586,27 +828,22 @@ def order_items():
             print('Authentication error')
             return {'error': 'Authentication error'}, ValidationError
 
-        all_orders = list(map(lambda json: Order(order_id, int(json["menu_id"]), json["quantity"]),
-                              request.json['order_list']))
-
-        if len(all_orders) == 0:
-            print('no orders found')
-            return {'error': 'order items cannot be empty'}, ValidationError
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key is not None and not idempotency.valid_key(idempotency_key):
+            print('Invalid idempotency key')
+            return {'error': 'Invalid Idempotency-Key'}, ValidationError
 
-        for order in all_orders:
-            if not order.is_valid():
-                print('invalid input. menu id: ' + order.menu_id + '\t quantity: ' + order.quantity)
-                return {"error": "Invalid input"}, ValidationError
+        replayed = idempotency.replay(user_id, 'order_items', idempotency_key)
+        if replayed is not None:
+            return replayed
 
-        menu_ids = tuple(map(lambda order: order.menu_id, all_orders))
-
-        if len(set(menu_ids)) != len(menu_ids):
-            print('menu id repeated: %s' % list(menu_ids))
-            return {'error': 'Menu id cannot be repeated'}, ValidationError
+        all_orders, error = _parse_basket(order_id, request.json['order_list'])
+        if error:
+            return {'error': error}, ValidationError
 
         with connection() as conn, conn.cursor() as cur:
             cur.execute(
-                'select user_id from orders where id = %s',
+                'select user_id, restaurant_id from orders where id = %s',
                 (order_id,)
             )
 
@@ -614,63 +851,178 @@ def order_items():
                 print('No such order found')
                 return {'error': 'No such order found'}, ValidationError
 
-            if cur.fetchone()[0] != user_id:
-                print('Authorization error')
-                return {'error': 'Authorization error'}, ValidationError
-
-            cur.execute('select id, price, restaurant_id, active_menu from menu where id in %s', (menu_ids,))
-            rows = cur.fetchall()
-            restaurant_ids = list(map(lambda row: row[2], rows))
-            active_menus = list(map(lambda row: row[3], rows))
-
-            if 1 in active_menus:
-                return {"error": "Can't order Disabled Items."}, ValidationError
-
-            if len(restaurant_ids) == 0:
-                print('Menu id does not exist')
-                return {'error': 'Menu id does not exist'}, ValidationError
-
-            if len(set(restaurant_ids)) != 1:
-                print('Cannot order from multiple restaurants')
-                return {'error': 'Cannot order from multiple restaurants'}, ValidationError
-
-            if len(restaurant_ids) != len(menu_ids):
-                print('One or more menu ides does not exist')
-                return {'error': 'One or more menu ids does not exist'}, ValidationError
-
-            prices = {}
-            for id, price, _, x in rows:
-                prices[id] = float(price)
-
-            for order in all_orders:
-                order.price = prices[order.menu_id] * order.quantity
-                print('menu id: ' + str(order.menu_id))
-                print('price: ' + str(prices[order.menu_id]))
-
-            # execute many raises type error for some reason
-            for order in all_orders:
-                cur.execute(
-                    "insert into order_items(order_id, menu_id, quantity, price) values "
-                    "(%s,%s,%s,%s) on duplicate key "
-                    "update quantity = quantity + %s, price = price + %s ",
-                    (order.order_id, order.menu_id, order.quantity,
-                     order.price, order.quantity, order.price)
-                )
-                cur.execute("insert into new_orders(id, order_id, menu_id, quantity) values(%s,%s,%s,%s)",
-                            (uuid4(), order.order_id, order.menu_id, order.quantity))
-            price_excluding_tax = sum(map(lambda o: o.price, all_orders))
-
-            cur.execute("update orders set price_excluding_tax = price_excluding_tax + %s where id = %s",
-                        (price_excluding_tax, order_id))
+            order_user_id, restaurant_id = cur.fetchone()
 
-            conn.commit()
+        if order_user_id != user_id:
+            print('Authorization error')
+            return {'error': 'Authorization error'}, ValidationError
+
+        # items can only come from the restaurant the order was created for,
+        # so its cached menu is all we need to validate and price them. Not
+        # while holding a connection - on a miss this waits for whichever
+        # request loads the menu, and that one needs a connection of its own
+        error = _price_basket(menu_cache.get(restaurant_id), all_orders)
+        if error:
+            return {'error': error}, ValidationError
+        restaurant = restaurant_cache.get(None, restaurant_id)
+        if restaurant is None:
+            print('Restaurant id does not exist')
+            return {'error': 'Restaurant id does not exist'}, ValidationError
+
+        with connection() as conn, conn.cursor() as cur:
+            if not insert_order_items(cur, order_id, restaurant_id, all_orders, restaurant.tax_percent):
+                print("Can't order Disabled Items.")
+                return {'error': "Can't order Disabled Items."}, ValidationError
+
+            added = {"success": True}
+            response = idempotency.commit(conn, user_id, 'order_items', idempotency_key, added)
+            pin_to_primary(user_id)
+
+        # a retry that lost the race gets the first response and nothing was written
+        if response is added:
+            events.publish(events.ItemsAdded(order_id, restaurant_id,
+                                             [(order.menu_id, order.quantity) for order in all_orders]))
+
+        return response
+    except (KeyError, TypeError, ValueError) as e:
+        print('Invalid input: ' + str(e))
+        return {'error': 'Invalid input'}, ValidationError
+
+
+@user.route("/place_order", methods=['POST'])
+def place_order():
+    """
+    Creates an order with its items in one request, the same as /order
+    followed by /order_items.
+    url - /api/v1/place_order?restaurant_id=<restaurant id>&table=<table>
+    Headers - X-Auth-Token: <jwt>
+              Idempotency-Key: <optional, any unique string up to 64 characters>
+    sample input -
+    {
+        "order_list": [
+            {
+                "menu_id": 1,
+                "quantity": 2
+            },
+            {
+                "menu_id": 2,
+                "quantity": 3
+            }
+        ]
+    }
+    sample output -
+    {
+        "order_id": "38trfghere yfrguoi rgrgg",
+        "tax_percent": 5.0,
+        "price_excluding_tax": 250.0,
+        "tax": 12.5,
+        "total": 262.5
+    }
+    sample error -
+    {
+        "error": "reason for error"
+    }
+    """
+    try:
+        if not request.json:
+            print('no json found')
+            return {"error": "Invalid Request/ No Json Data Found."}, ValidationError
+
+        user_id = _decoded_user_id(request)
+        if not user_id:
+            print('Authentication error')
+            return {'error': 'Authentication error'}, ValidationError
+
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key is not None and not idempotency.valid_key(idempotency_key):
+            print('Invalid idempotency key')
+            return {'error': 'Invalid Idempotency-Key'}, ValidationError
+
+        replayed = idempotency.replay(user_id, 'place_order', idempotency_key)
+        if replayed is not None:
+            return replayed
 
-        return {"success": True}
-    except (KeyError, TypeError) as e:
-        print('Invalid input: ' + e)
+        table = request.args.get('table')
+        if not table:
+            print('Table absent')
+            return {'error': 'table parameter not found in request'}, ValidationError
+
+        restaurant_id = request.args.get('restaurant_id')
+        if not restaurant_id:
+            print('Restaurant id not found')
+            return {'error': 'restaurant id not found'}, ValidationError
+
+        order_id = str(uuid4())
+
+        all_orders, error = _parse_basket(order_id, request.json['order_list'])
+        if error:
+            return {'error': error}, ValidationError
+
+        # the restaurant, its tables and menu are all cached, so a connection
+        # is only opened once the order is known to be valid
+        restaurant = restaurant_cache.get(None, restaurant_id)
+        if restaurant is None:
+            print('Restaurant id does not exist')
+            return {'error': 'Restaurant id does not exist'}, ValidationError
+
+        if not restaurant_cache.has_table(None, restaurant_id, table):
+            print('Table not found')
+            return {'error': 'Table not found'}, ValidationError
+
+        error = _price_basket(menu_cache.get(restaurant_id), all_orders)
+        if error:
+            return {'error': error}, ValidationError
+
+        with connection() as conn, conn.cursor() as cur:
+            if not _insert_order(cur, order_id, user_id, restaurant_id, table):
+                print('Table not found')
+                return {'error': 'Table not found'}, ValidationError
+
+            if not insert_order_items(cur, order_id, restaurant_id, all_orders, restaurant.tax_percent):
+                print("Can't order Disabled Items.")
+                return {'error': "Can't order Disabled Items."}, ValidationError
+
+            # the amounts as the database rounded them, which is what checkout
+            # charges. Rounding floats here would be a cent off now and then
+            cur.execute(
+                'select price_excluding_tax, tax, total from orders where id = %s',
+                (order_id,)
+            )
+            price_excluding_tax, tax, total = cur.fetchone()
+
+            placed = {
+                'order_id': order_id,
+                'tax_percent': float(restaurant.tax_percent),
+                'price_excluding_tax': float(price_excluding_tax),
+                'tax': float(tax),
+                'total': float(total),
+            }
+            response = idempotency.commit(conn, user_id, 'place_order', idempotency_key, placed)
+            pin_to_primary(user_id)
+
+        # a retry that lost the race gets the first response and nothing was written
+        if response is placed:
+            events.publish(events.OrderCreated(order_id, restaurant_id, user_id, table))
+            events.publish(events.ItemsAdded(order_id, restaurant_id,
+                                             [(order.menu_id, order.quantity) for order in all_orders]))
+
+        return response
+    except (KeyError, TypeError, ValueError) as e:
+        print('Invalid input: ' + str(e))
         return {'error': 'Invalid input'}, ValidationError
 
 
+# explain_report explains this query
+OrderHistoryQuery = (
+    "Select orders.id, restaurant.name, orders.total, orders.time_and_date,"
+    "restaurant.tax_percent,restaurant.photo_url "
+    "from orders "
+    "join restaurant on orders.restaurant_id = restaurant.id "
+    "where orders.user_id= %(user_id)s "
+    "order by orders.time_and_date desc"
+)
+
+
 @user.route("/order_history", methods=['POST'])
 def get_order_history():
     """
@@ -713,15 +1065,10 @@ def get_order_history():
         if user_id is None:
             print('Username not found')
             return {"error": "Username can't be None."}, ValidationError
-        with connection() as conn, conn.cursor() as cur:
+        with connection(readonly=True, key=user_id) as conn, conn.cursor() as cur:
             cur.execute(
-                "Select orders.id, restaurant.name, orders.price_excluding_tax+orders.tax, orders.time_and_date,"
-                "restaurant.tax_percent,restaurant.photo_url "
-                "from orders "
-                "join restaurant on orders.restaurant_id = restaurant.id "
-                "where orders.user_id= %s "
-                "order by orders.time_and_date desc",
-                (user_id,)
+                OrderHistoryQuery,
+                {'user_id': user_id}
             )
 
             order_history = cur.fetchall()
@@ -885,7 +1232,7 @@ def update_user():
 
     try:
         # validating email and assigning the valid email back to email
-        email = validate_email(email).email
+        email = validate_signup_email(email)
     except EmailNotValidError:
         print('invalid email')
         return {'error': 'email is not valid'}, ValidationError